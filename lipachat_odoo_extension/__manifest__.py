@@ -30,13 +30,14 @@
     'author': 'LipaChat Gateway',
     'website': 'https://lipachat.com',
     'license': 'LGPL-3',
-    'depends': ['base', 'mail', 'contacts', 'web'],
+    'depends': ['base', 'bus', 'mail', 'contacts', 'web'],
     'data': [
         'security/ir.model.access.csv',
         'data/lipachat_data.xml',
         'views/lipachat_config_views.xml',
         'views/lipachat_message_views.xml',
         'views/lipachat_template_views.xml',
+        'views/lipachat_campaign_views.xml',
         'views/res_partner_views.xml',
         'views/lipachat_whatsapp_chat.xml',
         'views/lipachat_menus.xml',
@@ -53,6 +54,7 @@
     'web.assets_backend': [
         'lipachat_odoo_extension/static/src/css/chat_interface.css',
         'lipachat_odoo_extension/static/src/css/whatsapp_template.css',
+        'lipachat_odoo_extension/static/src/js/lipachat_bus_service.js',
         'lipachat_odoo_extension/static/src/js/whatsapp_chat_client.js',
         'lipachat_odoo_extension/static/src/js/lipachat_template_client.js',
     ],
@@ -1,5 +1,11 @@
 from . import lipachat_config
 from . import lipachat_message
 from . import lipachat_template
+from . import lipachat_media
+from . import lipachat_contact_session
+from . import lipachat_conversation
+from . import lipachat_read_marker
+from . import lipachat_campaign
 from . import whatsapp_chat
-from . import res_partner
\ No newline at end of file
+from . import res_partner
+from . import ir_websocket
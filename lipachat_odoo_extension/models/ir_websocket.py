@@ -0,0 +1,15 @@
+from odoo import models
+
+from .lipachat_message import CHAT_BUS_CHANNEL
+
+
+class IrWebsocket(models.AbstractModel):
+    _inherit = 'ir.websocket'
+
+    def _build_bus_channel_list(self, channels):
+        # The chat channel carries contact activity: internal users only
+        if CHAT_BUS_CHANNEL in channels:
+            channels = [channel for channel in channels if channel != CHAT_BUS_CHANNEL]
+            if self.env.uid and self.env.user._is_internal():
+                channels.append(CHAT_BUS_CHANNEL)
+        return super()._build_bus_channel_list(channels)
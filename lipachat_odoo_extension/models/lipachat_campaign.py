@@ -0,0 +1,402 @@
+from odoo import models, fields, api, _
+from odoo.exceptions import ValidationError, UserError
+import time
+import bisect
+import hashlib
+import logging
+
+from .lipachat_message import DISPATCH_LANES
+
+_logger = logging.getLogger(__name__)
+
+# Compiled template payloads of running campaigns, per worker
+_compiled_payloads = {}
+_COMPILED_PAYLOADS_MAX = 128
+
+# Points each unit of send rate puts on the sender hash ring
+_RING_POINTS_PER_RATE = 4
+
+
+def _ring_hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _build_sender_ring(configs):
+    """Build a consistent-hash ring over the sender pool.
+
+    Each configuration gets points in proportion to its send rate, so faster
+    numbers receive more contacts, and adding or removing a number only
+    moves the contacts of the ring segments it owns.
+    """
+    points = sorted(
+        (_ring_hash(f"{config.id}:{point}"), config.id)
+        for config in configs
+        for point in range(max(config.send_rate_limit, 1) * _RING_POINTS_PER_RATE)
+    )
+    return [point[0] for point in points], [point[1] for point in points]
+
+
+def _pick_sender(ring, phone):
+    """Return the configuration id owning this phone number on the ring"""
+    hashes, config_ids = ring
+    index = bisect.bisect(hashes, _ring_hash(phone)) % len(hashes)
+    return config_ids[index]
+
+class LipachatCampaign(models.Model):
+    _name = 'lipachat.campaign'
+    _description = 'WhatsApp Campaign'
+    _order = 'create_date desc'
+
+    # Seconds a single cron run may spend dispatching before it hands over
+    # to the next run, keeping each run well inside the worker time limit
+    _dispatch_time_budget = 60
+
+    name = fields.Char('Campaign Name', required=True)
+    message_id = fields.Many2one(
+        'lipachat.message',
+        string='Message',
+        required=True,
+        ondelete='restrict',
+        domain=[('bulk_parent_id', '=', False), ('is_incoming', '=', False)],
+        help='Message whose content is sent to every recipient of the campaign'
+    )
+    config_id = fields.Many2one(
+        'lipachat.config',
+        string='Configuration',
+        domain=[('active', '=', True)],
+        required=True,
+        default=lambda self: self.env['lipachat.config'].search([('active', '=', True)], limit=1),
+    )
+    dispatch_lane = fields.Selection(DISPATCH_LANES, 'Dispatch Lane', related='message_id.dispatch_lane',
+                                     store=True, readonly=True)
+    config_ids = fields.Many2many(
+        'lipachat.config',
+        string='Sender Pool',
+        domain=[('active', '=', True)],
+        help='Numbers sharing the campaign traffic; each contact always gets the same sender. '
+             'Defaults to the configuration above.'
+    )
+    partner_ids = fields.Many2many('res.partner', string='Recipients')
+    child_message_ids = fields.One2many('lipachat.message', 'campaign_id', 'Messages')
+
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('scheduled', 'Scheduled'),
+        ('running', 'Running'),
+        ('paused', 'Paused'),
+        ('done', 'Done'),
+        ('cancelled', 'Cancelled'),
+    ], string='Status', default='draft', readonly=True)
+
+    chunk_size = fields.Integer('Chunk Size', default=100,
+                                help='Number of messages sent per transaction')
+
+    # Derived from the state of the campaign messages, the dispatcher never writes the campaign
+    total_count = fields.Integer('Total', compute='_compute_counters')
+    queued_count = fields.Integer('Queued', compute='_compute_counters')
+    sent_count = fields.Integer('Sent', compute='_compute_counters')
+    failed_count = fields.Integer('Failed', compute='_compute_counters')
+    progress = fields.Float('Progress', compute='_compute_progress')
+
+    scheduled_at = fields.Datetime('Scheduled At', copy=False,
+                                   help='Start the campaign at this date, e.g. off-peak, instead of right away')
+    started_at = fields.Datetime('Started At', readonly=True, copy=False)
+    finished_at = fields.Datetime('Finished At', readonly=True, copy=False)
+
+    @api.depends('child_message_ids.state')
+    def _compute_counters(self):
+        counts = {campaign.id: {'queued': 0, 'sent': 0, 'failed': 0} for campaign in self}
+        groups = self.env['lipachat.message']._read_group(
+            [('campaign_id', 'in', self.ids)],
+            ['campaign_id', 'state'],
+            ['__count'],
+        )
+        for campaign, state, count in groups:
+            if state == 'DRAFT':
+                counts[campaign.id]['queued'] += count
+            elif state == 'FAILED':
+                counts[campaign.id]['failed'] += count
+            else:
+                counts[campaign.id]['sent'] += count
+
+        for campaign in self:
+            campaign_counts = counts.get(campaign.id, {'queued': 0, 'sent': 0, 'failed': 0})
+            campaign.total_count = sum(campaign_counts.values())
+            campaign.queued_count = campaign_counts['queued']
+            campaign.sent_count = campaign_counts['sent']
+            campaign.failed_count = campaign_counts['failed']
+
+    @api.depends('total_count', 'sent_count', 'failed_count')
+    def _compute_progress(self):
+        for campaign in self:
+            if campaign.total_count:
+                done = campaign.sent_count + campaign.failed_count
+                campaign.progress = 100.0 * done / campaign.total_count
+            else:
+                campaign.progress = 0.0
+
+    @api.constrains('chunk_size')
+    def _check_chunk_size(self):
+        for campaign in self:
+            if campaign.chunk_size <= 0:
+                raise ValidationError(_("Chunk size must be a positive number"))
+
+    def action_start(self):
+        """Materialise one message per recipient and queue the campaign for dispatch.
+
+        A campaign scheduled in the future is only validated here; the
+        dispatcher cron starts it once it is due.
+        """
+        now = fields.Datetime.now()
+        for campaign in self:
+            if campaign.state not in ('draft', 'scheduled'):
+                raise UserError(_("Only draft campaigns can be started."))
+            senders = campaign._get_sender_pool()
+            if not all(senders.mapped('api_key')):
+                raise ValidationError(_("Please configure you API key before sending messages."))
+
+            template = campaign.message_id
+            recipients, invalid = template._normalize_recipients(campaign._get_recipients(), campaign.config_id)
+            if not recipients:
+                raise ValidationError(_("None of the selected recipients has a valid phone number."))
+
+            if campaign.state == 'draft' and campaign.scheduled_at and campaign.scheduled_at > now:
+                campaign.state = 'scheduled'
+                continue
+
+            template.is_bulk_template = True
+            ring = _build_sender_ring(senders)
+            recipients_by_sender = {}
+            for recipient in recipients:
+                recipients_by_sender.setdefault(_pick_sender(ring, recipient['phone']), []).append(recipient)
+
+            # Invalid numbers are recorded as failed and never dispatched
+            vals_list = template._prepare_bulk_vals_list(invalid, fail_reason=_("Invalid phone number"))
+            for vals in vals_list:
+                vals['config_id'] = campaign.config_id.id
+            # Sessions are checked chunk by chunk by the dispatcher, not in this request
+            for sender_id, sender_recipients in recipients_by_sender.items():
+                sender_vals_list = template._prepare_bulk_vals_list(sender_recipients)
+                for vals in sender_vals_list:
+                    vals['config_id'] = sender_id
+                vals_list += sender_vals_list
+            for vals in vals_list:
+                vals['campaign_id'] = campaign.id
+            self.env['lipachat.message'].create(vals_list)
+
+            campaign.write({
+                'state': 'running',
+                'started_at': fields.Datetime.now(),
+            })
+            campaign._update_counters()
+
+        self._trigger_dispatch()
+        return True
+
+    def action_pause(self):
+        self.filtered(lambda c: c.state == 'running').write({'state': 'paused'})
+        return True
+
+    def action_resume(self):
+        self.filtered(lambda c: c.state == 'paused').write({'state': 'running'})
+        self._trigger_dispatch()
+        return True
+
+    def action_cancel(self):
+        self.filtered(lambda c: c.state in ('draft', 'scheduled', 'running', 'paused')).write({
+            'state': 'cancelled',
+            'finished_at': fields.Datetime.now(),
+        })
+        return True
+
+    def action_view_messages(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Campaign Messages'),
+            'res_model': 'lipachat.message',
+            'view_mode': 'tree,form',
+            'domain': [('campaign_id', '=', self.id)],
+        }
+
+    def _get_recipients(self):
+        """Return the raw recipient dicts of the campaign partners"""
+        self.ensure_one()
+        return [{
+            'phone': partner.mobile or partner.phone,
+            'name': partner.name,
+            'partner_id': partner.id,
+        } for partner in self.partner_ids]
+
+    def _get_sender_pool(self):
+        self.ensure_one()
+        return self.config_ids or self.config_id
+
+    def _trigger_dispatch(self):
+        cron = self.env.ref('lipachat_odoo_extension.ir_cron_dispatch_campaigns', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+
+    def _update_counters(self):
+        """Refresh the bulk statistics of the campaign message; the campaign counters are computed"""
+        self.message_id._update_bulk_counters()
+
+    def _get_compiled_payload(self, config):
+        """Return the campaign's template payload for a configuration, compiling it once.
+
+        The key only holds what the payload is made of: the parent message is
+        written after every chunk (its bulk counters) and must not expire it.
+        """
+        self.ensure_one()
+        message = self.message_id
+        template = message.template_name
+        key = (self.env.cr.dbname, self.id, config.id, config.default_from_number, template.id, template.write_date,
+               message.template_media_url, message.template_placeholders)
+        compiled = _compiled_payloads.get(key)
+        if compiled is None:
+            if len(_compiled_payloads) >= _COMPILED_PAYLOADS_MAX:
+                _compiled_payloads.clear()
+            compiled = _compiled_payloads[key] = self.message_id._compile_template_payload(config)
+        return compiled
+
+    def _fail_sessionless_messages(self, messages):
+        """Fail the free-form messages of a chunk whose contact has no open session.
+
+        Sessions are checked per sender number, for the whole chunk at once.
+        Returns the failed messages.
+        """
+        self.ensure_one()
+        failed = self.env['lipachat.message']
+        for config in messages.config_id:
+            sender_messages = messages.filtered(lambda msg: msg.config_id == config)
+            _eligible, needs_template = self.message_id._preflight_session_check(
+                [{'phone': msg.phone_number, 'message_id': msg.id} for msg in sender_messages], config)
+            failed |= failed.browse([recipient['message_id'] for recipient in needs_template])
+        if failed:
+            fail_reason = self.message_id._no_session_fail_reason()
+            failed.write({'state': 'FAILED', 'error_message': fail_reason, 'fail_reason': fail_reason})
+        return failed
+
+    def _dispatch_next_chunk(self, deadline=None):
+        """Send the next chunk of queued messages.
+
+        Queued messages are the campaign's DRAFT messages in id order: each
+        one is committed right after its send, so a worker that is killed
+        mid-chunk resumes with the first message it had not sent yet, and
+        never sends a message twice. The campaign row itself is not written,
+        so pausing or cancelling it from the interface never conflicts with
+        a send; both are honoured before the next message.
+        Messages of senders whose gateway circuit is open are passed over
+        until it closes. Returns False when nothing can be sent right now.
+        """
+        self.ensure_one()
+        domain = [
+            ('campaign_id', '=', self.id),
+            ('state', '=', 'DRAFT'),
+        ]
+        open_senders = self._get_sender_pool().filtered(lambda config: config._circuit_is_open())
+        if open_senders:
+            domain.append(('config_id', 'not in', open_senders.ids))
+        messages = self.env['lipachat.message'].search(domain, order='id', limit=self.chunk_size)
+
+        if not messages:
+            if self.env['lipachat.message'].search_count([('campaign_id', '=', self.id), ('state', '=', 'DRAFT')]):
+                # Only messages of unavailable senders are left
+                return False
+            self.write({'state': 'done', 'finished_at': fields.Datetime.now()})
+            self._update_counters()
+            return False
+
+        messages -= self._fail_sessionless_messages(messages)
+        # Sends are committed one by one: publish their chat update once for the chunk
+        messages = messages.with_context(lipachat_defer_chat_notify=True)
+        for msg in messages:
+            # Pick up pause/cancel requests and the time budget before every send
+            self.invalidate_recordset(['state'])
+            if self.state != 'running' or (deadline and time.monotonic() >= deadline):
+                break
+            recipient = {
+                'phone': msg.phone_number,
+                'name': msg.partner_id.name or msg.phone_number,
+                'partner_id': msg.partner_id.id,
+            }
+            if msg.message_type == 'template':
+                msg = msg.with_context(lipachat_compiled_payload=self._get_compiled_payload(msg.config_id))
+            try:
+                msg._send_single_message(recipient, msg.config_id)
+            except Exception as e:
+                _logger.error(f"Campaign {self.name}: failed to send message {msg.id}: {str(e)}")
+                msg.write({'state': 'FAILED', 'error_message': str(e), 'fail_reason': str(e)})
+
+            if msg.state == 'DRAFT':
+                if msg.config_id._circuit_is_open():
+                    # This sender's gateway is down: keep the message queued
+                    _logger.warning(f"Campaign {self.name}: circuit open for {msg.config_id.name}, message kept queued")
+                else:
+                    # The gateway refused the message without failing it (e.g. an
+                    # expired contact session); never leave it queued forever
+                    fail_reason = _("Message was not accepted by the gateway")
+                    msg.write({'state': 'FAILED', 'error_message': fail_reason, 'fail_reason': fail_reason})
+            # The message is out: record it before sending the next one
+            self.env.cr.commit()
+
+        self.env['lipachat.message']._notify_chat_clients(messages.partner_id.ids)
+        self._update_counters()
+        return True
+
+    @api.model
+    def _start_due_campaigns(self):
+        """Start the scheduled campaigns whose date has come"""
+        campaigns = self.search([
+            ('state', '=', 'scheduled'),
+            ('scheduled_at', '<=', fields.Datetime.now()),
+        ], order='scheduled_at, id')
+        for campaign in campaigns:
+            try:
+                with self.env.cr.savepoint():
+                    campaign.action_start()
+            except (UserError, ValidationError) as e:
+                _logger.error(f"Campaign {campaign.name}: scheduled start failed: {str(e)}")
+                campaign.write({'state': 'cancelled', 'finished_at': fields.Datetime.now()})
+            except Exception as e:
+                # Never let one campaign stop the dispatch of the others, nor retry it every run
+                _logger.exception(f"Campaign {campaign.name}: scheduled start failed unexpectedly: {str(e)}")
+                campaign.write({'state': 'cancelled', 'finished_at': fields.Datetime.now()})
+            self.env.cr.commit()
+
+    @api.model
+    def _cron_dispatch_campaigns(self):
+        """Dispatch running campaigns chunk by chunk, committing after every message.
+
+        Campaigns are re-read before every chunk so that a campaign started
+        in a higher priority lane is served as soon as the current chunk is
+        done, without waiting for a long marketing campaign to finish.
+        """
+        self._start_due_campaigns()
+        message_model = self.env['lipachat.message']
+        deadline = time.monotonic() + self._dispatch_time_budget
+        spent = {}
+        stalled = set()
+
+        while True:
+            if time.monotonic() >= deadline:
+                _logger.info("Campaign dispatch time budget used, continuing in next run")
+                self._trigger_dispatch()
+                break
+
+            # Pick up start/pause/cancel requests made while we were sending
+            self.invalidate_model(['state'])
+            campaigns = self.search([('state', '=', 'running'), ('id', 'not in', list(stalled))],
+                                    order='started_at, id')
+            lane = message_model._pick_dispatch_lane(set(campaigns.mapped('dispatch_lane')), spent)
+            if not lane:
+                break
+
+            campaign = campaigns.filtered(lambda c: c.dispatch_lane == lane)[0]
+            chunk_start = time.monotonic()
+            if not campaign._dispatch_next_chunk(deadline):
+                # Done, or waiting for its senders' gateways to recover
+                stalled.add(campaign.id)
+            self.env.cr.commit()
+            spent[lane] = spent.get(lane, 0.0) + time.monotonic() - chunk_start
+        return True
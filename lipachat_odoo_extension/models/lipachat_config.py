@@ -1,10 +1,15 @@
 from odoo import models, fields, api, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import ValidationError, UserError
 import requests
 import logging
 
 _logger = logging.getLogger(__name__)
 
+
+class GatewayUnavailableError(UserError):
+    """Raised without contacting the gateway while a configuration's circuit is open"""
+
+
 class LipachatConfig(models.Model):
     _name = 'lipachat.config'
     _description = 'Lipachat Configuration'
@@ -14,6 +19,17 @@ class LipachatConfig(models.Model):
     api_key = fields.Char('API Key', help='Get your API key from https://app.lipachat.com/auth/signup')
     api_base_url = fields.Char('API Base URL', default='https://gateway.lipachat.com/api/v1', required=True)
     default_from_number = fields.Char('From Number', help='Default WhatsApp Business number (e.g., 254110090747)')
+    send_rate_limit = fields.Integer(
+        'Send Rate Limit',
+        default=20,
+        help='Messages per second this number may send; sets its share of campaign traffic in a sender pool'
+    )
+    default_country_id = fields.Many2one(
+        'res.country',
+        string='Default Country',
+        default=lambda self: self.env.ref('base.ke', raise_if_not_found=False),
+        help='Country whose calling code completes national numbers such as 0712345678'
+    )
     active = fields.Boolean('Active', default=True)
     test_connection = fields.Boolean('Test Connection', compute='_compute_test_connection')
 
@@ -28,6 +44,25 @@ class LipachatConfig(models.Model):
         default=1,
         help="How often to check for new messages (in minutes)"
     )
+
+    # Circuit breaker: stop waiting on gateway timeouts during an outage
+    circuit_state = fields.Selection([
+        ('closed', 'Closed'),
+        ('open', 'Open'),
+        ('half_open', 'Half-Open'),
+    ], string='Gateway Circuit', default='closed', readonly=True, copy=False)
+    circuit_failure_count = fields.Integer('Consecutive Failures', readonly=True, copy=False)
+    circuit_opened_at = fields.Datetime('Circuit Opened At', readonly=True, copy=False)
+    circuit_failure_threshold = fields.Integer(
+        'Failure Threshold',
+        default=5,
+        help="Consecutive gateway failures after which requests fail fast"
+    )
+    circuit_reset_timeout = fields.Integer(
+        'Retry After (seconds)',
+        default=60,
+        help="How long the circuit stays open before a probe request is let through"
+    )
     
     @api.depends('api_key', 'api_base_url')
     def _compute_test_connection(self):
@@ -66,6 +101,7 @@ class LipachatConfig(models.Model):
                 timeout=10
             )
             if response.status_code == 200:
+                self._circuit_record_success()
                 return {
                     'type': 'ir.actions.client',
                     'tag': 'display_notification',
@@ -86,4 +122,101 @@ class LipachatConfig(models.Model):
         config = self.search([('active', '=', True)], limit=1)
         if not config:
             raise ValidationError(_('No active LipaChat configuration found. Please configure the API settings.'))
-        return config
\ No newline at end of file
+        return config
+
+    def action_reset_circuit(self):
+        """Manually close the circuit, e.g. once the gateway is known to be back"""
+        for record in self:
+            record._circuit_record_success()
+        return True
+
+    def _circuit_is_open(self):
+        """Return True while requests through this configuration must fail fast"""
+        self.ensure_one()
+        if self.circuit_state == 'closed':
+            return False
+        if not self.circuit_opened_at:
+            return False
+        elapsed = (fields.Datetime.now() - self.circuit_opened_at).total_seconds()
+        return elapsed < self.circuit_reset_timeout
+
+    def _circuit_allow_request(self):
+        """Decide whether a request may go out, letting one probe through when half-open"""
+        self.ensure_one()
+        if self.circuit_state == 'closed':
+            return True
+        if self._circuit_is_open():
+            return False
+        # Retry delay elapsed: move to half-open and let this request probe the gateway.
+        # Restarting the clock keeps other workers failing fast meanwhile.
+        _logger.info(f"Gateway circuit of {self.name} is half-open, probing")
+        self._circuit_write({
+            'circuit_state': 'half_open',
+            'circuit_opened_at': fields.Datetime.now(),
+        })
+        return True
+
+    def _circuit_record_success(self):
+        self.ensure_one()
+        if self.circuit_state != 'closed' or self.circuit_failure_count:
+            if self.circuit_state != 'closed':
+                _logger.info(f"Gateway circuit of {self.name} closed")
+            self._circuit_write({
+                'circuit_state': 'closed',
+                'circuit_failure_count': 0,
+                'circuit_opened_at': False,
+            })
+
+    def _circuit_record_failure(self):
+        self.ensure_one()
+        failures = self.circuit_failure_count + 1
+        vals = {'circuit_failure_count': failures}
+        if self.circuit_state == 'half_open' or failures >= self.circuit_failure_threshold:
+            _logger.warning(f"Gateway circuit of {self.name} opened after {failures} consecutive failures")
+            vals.update({
+                'circuit_state': 'open',
+                'circuit_opened_at': fields.Datetime.now(),
+            })
+        self._circuit_write(vals)
+
+    def _circuit_write(self, vals):
+        """Persist circuit state in its own short transaction.
+
+        The state must survive a rollback of the request that saw the failure,
+        and must not keep the configuration row locked for the length of a
+        long dispatch transaction.
+        """
+        try:
+            with self.env.registry.cursor() as cr:
+                cr.execute("SET LOCAL lock_timeout = '2s'")
+                self.with_env(self.env(cr=cr)).write(vals)
+        except Exception as e:
+            _logger.warning(f"Could not persist gateway circuit state for {self.name}: {str(e)}")
+        # Make the new state visible to the current transaction as well
+        for field_name, value in vals.items():
+            field = self._fields[field_name]
+            self.env.cache.update(self, field, [field.convert_to_cache(value, self)])
+
+    def _gateway_request(self, method, url, **kwargs):
+        """Send an HTTP request to the gateway through the circuit breaker.
+
+        Network errors and 5xx responses count as failures; any other response
+        proves the gateway is reachable and closes the circuit.
+        """
+        self.ensure_one()
+        if not self._circuit_allow_request():
+            raise GatewayUnavailableError(
+                _("LipaChat gateway is unavailable, retrying after %s seconds.") % self.circuit_reset_timeout
+            )
+
+        try:
+            response = requests.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._circuit_record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self._circuit_record_failure()
+        else:
+            self._circuit_record_success()
+        return response
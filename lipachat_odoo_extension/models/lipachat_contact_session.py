@@ -0,0 +1,203 @@
+from odoo import models, fields, api
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import functools
+import requests
+import json
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_ACTIVE_SESSION_URL = "https://app.lipachat.com/api/v1/sandbox/contact/active-session/%s"
+
+
+def _phone_key_sql(column):
+    """SQL expression turning a phone column into the key _normalize_phone gives it.
+
+    Same rules, with the calling code passed as %(country_code)s, and the
+    same validity checks: numbers _normalize_phone rejects give NULL.
+    """
+    digits = f"regexp_replace({column}, '[^0-9]', '', 'g')"
+    return f"""(SELECT CASE WHEN normalised.key ~ '^[1-9][0-9]{{7,14}}$' THEN normalised.key END
+          FROM (SELECT CASE
+                       WHEN {column} ~ '^\\s*\\+' THEN {digits}
+                       WHEN {digits} LIKE '00%%' THEN substr({digits}, 3)
+                       WHEN {digits} LIKE '0%%' THEN %(country_code)s || substr({digits}, 2)
+                       WHEN length({digits}) <= 10 AND left({digits}, length(%(country_code)s)) != %(country_code)s
+                           THEN %(country_code)s || {digits}
+                       ELSE {digits} END AS key) normalised)"""
+
+
+def _fetch_session_info(api_key, phone):
+    """Ask the gateway whether a contact has an active session.
+
+    Plain HTTP without any ORM access, so that it can run in worker threads.
+    Returns (session_info, status_code); status_code is None on network errors.
+    """
+    try:
+        response = requests.get(_ACTIVE_SESSION_URL % phone, headers={'apiKey': api_key}, timeout=5)
+    except requests.exceptions.RequestException as e:
+        return {'status': False, 'message': str(e), 'session_active': False, 'checked': False}, None
+
+    if response.status_code != 200:
+        return {
+            'status': False,
+            'message': f'API request failed with status {response.status_code}',
+            'session_active': False,
+            'checked': False
+        }, response.status_code
+
+    try:
+        data = response.json()
+    except ValueError:
+        return {'status': False, 'message': 'Invalid API response format', 'session_active': False, 'checked': False}, None
+
+    _logger.debug("Session info response for %s: %s", phone, data)
+    if data.get('status') and data.get('session'):
+        # Check if session is expired
+        expires_at = data['session'].get('expiresAt')
+        if expires_at:
+            try:
+                expires_dt = datetime.strptime(expires_at, "%Y-%m-%dT%H:%M:%S.%f%z")
+                if expires_dt > datetime.now(timezone.utc):
+                    return {
+                        'status': True,
+                        'session_active': True,
+                        'expires_at': expires_at,
+                        'session_data': data['session']
+                    }, 200
+            except ValueError as e:
+                _logger.error(f"Error parsing datetime {expires_at}: {str(e)}")
+
+    return {
+        'status': data.get('status', False),
+        'message': data.get('message', 'No active session'),
+        'session_active': False
+    }, 200
+
+class LipachatContactSession(models.Model):
+    _name = 'lipachat.contact.session'
+    _description = 'WhatsApp Contact Session Cache'
+    _log_access = False
+
+    # Seconds a "no active session" answer is trusted before asking again
+    _negative_ttl = 30
+    # Concurrent requests used to check the sessions of a recipient list
+    _check_workers = 8
+
+    config_id = fields.Many2one('lipachat.config', 'Configuration', required=True, ondelete='cascade')
+    phone = fields.Char('Phone Number', required=True)
+    session_active = fields.Boolean('Session Active')
+    session_info = fields.Text('Session Info', help='Last answer of the active-session endpoint')
+    valid_until = fields.Datetime('Valid Until', required=True)
+
+    _sql_constraints = [
+        ('config_phone_uniq', 'unique(config_id, phone)',
+         'A contact session is cached once per configuration.'),
+    ]
+
+    @api.model
+    def _cache_key(self, config, phone):
+        return self.env['lipachat.message']._clean_phone_number(phone, config)
+
+    @api.model
+    def _lookup(self, config, phone):
+        """Return the cached session info of a contact, or None when unknown or stale"""
+        return self._lookup_many(config, [phone]).get(phone)
+
+    @api.model
+    def _lookup_many(self, config, phones):
+        """Return {phone: session_info} for the contacts with a fresh cached answer"""
+        keys = {self._cache_key(config, phone): phone for phone in phones if phone}
+        if not keys:
+            return {}
+        self.env.cr.execute("""
+            SELECT phone, session_info
+              FROM lipachat_contact_session
+             WHERE config_id = %s AND phone IN %s AND valid_until > %s
+        """, (config.id, tuple(keys), fields.Datetime.now()))
+        return {keys[key]: json.loads(session_info) for key, session_info in self.env.cr.fetchall()}
+
+    @api.model
+    def _check_sessions(self, config, phones):
+        """Return {phone: session_info} for a list of contacts.
+
+        Cached answers are read in one query; the remaining contacts are
+        checked concurrently and their answers cached. Answers that could not
+        be obtained carry 'checked': False.
+        """
+        phones = list(dict.fromkeys(phone for phone in phones if phone))
+        results = self._lookup_many(config, phones)
+        missing = [phone for phone in phones if phone not in results]
+        if not missing:
+            return results
+
+        if config._circuit_is_open():
+            unavailable = {'status': False, 'message': 'Gateway unavailable', 'session_active': False, 'checked': False}
+            results.update(dict.fromkeys(missing, unavailable))
+            return results
+
+        fetch = functools.partial(_fetch_session_info, config.api_key)
+        with ThreadPoolExecutor(max_workers=min(self._check_workers, len(missing))) as executor:
+            answers = list(executor.map(fetch, missing))
+
+        failures = 0
+        answered = {}
+        for phone, (session_info, status_code) in zip(missing, answers):
+            results[phone] = session_info
+            if status_code == 200:
+                answered[phone] = session_info
+            elif status_code is None or status_code >= 500:
+                failures += 1
+        self._store_many(config, answered)
+
+        # Feed the gateway circuit breaker from this thread, the workers have no ORM access
+        if failures == len(missing):
+            config._circuit_record_failure()
+        elif not failures:
+            config._circuit_record_success()
+        return results
+
+    @api.model
+    def _store(self, config, phone, session_info):
+        """Cache a session answer until the session expires, or briefly when there is none"""
+        self._store_many(config, {phone: session_info})
+
+    @api.model
+    def _store_many(self, config, answers):
+        """Cache {phone: session_info} answers with a single multi-row upsert"""
+        rows = {}
+        negative_valid_until = fields.Datetime.now() + timedelta(seconds=self._negative_ttl)
+        for phone, session_info in answers.items():
+            valid_until = negative_valid_until
+            if session_info.get('session_active'):
+                try:
+                    expires_at = datetime.strptime(session_info['expires_at'], "%Y-%m-%dT%H:%M:%S.%f%z")
+                    valid_until = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+                except (KeyError, TypeError, ValueError):
+                    pass
+            # Keyed on the cache key: one upsert cannot touch the same row twice
+            key = self._cache_key(config, phone)
+            rows[key] = (config.id, key, bool(session_info.get('session_active')), json.dumps(session_info), valid_until)
+        if not rows:
+            return
+
+        # Upsert so that concurrent workers never conflict on the same contact
+        self.env.cr.execute(f"""
+            INSERT INTO lipachat_contact_session (config_id, phone, session_active, session_info, valid_until)
+                 VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))}
+            ON CONFLICT (config_id, phone) DO UPDATE
+                    SET session_active = EXCLUDED.session_active,
+                        session_info = EXCLUDED.session_info,
+                        valid_until = EXCLUDED.valid_until
+        """, [value for row in rows.values() for value in row])
+
+    @api.model
+    def _invalidate(self, config, phone):
+        """Forget the cached answer of a contact whose session may just have opened"""
+        if not phone:
+            return
+        self.env.cr.execute("""
+            DELETE FROM lipachat_contact_session
+             WHERE config_id = %s AND phone = %s
+        """, (config.id, self._cache_key(config, phone)))
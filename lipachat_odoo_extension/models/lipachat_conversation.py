@@ -0,0 +1,229 @@
+from odoo import models, fields, api
+import logging
+
+from .lipachat_contact_session import _phone_key_sql
+
+_logger = logging.getLogger(__name__)
+
+# A message belongs to a conversation once it was actually exchanged
+_CONVERSATION_MESSAGE_SQL = """
+    message.partner_id IS NOT NULL
+    AND message.state NOT IN ('FAILED', 'DRAFT', 'SCHEDULED')
+    AND message.is_bulk_template IS NOT TRUE
+"""
+
+class LipachatConversation(models.Model):
+    _name = 'lipachat.conversation'
+    _description = 'WhatsApp Conversation'
+    _order = 'last_message_date desc, id desc'
+    _log_access = False
+
+    partner_id = fields.Many2one('res.partner', 'Contact', required=True, ondelete='cascade', readonly=True)
+    config_id = fields.Many2one('lipachat.config', 'Configuration', required=True, ondelete='cascade', readonly=True)
+    phone_number = fields.Char('Phone Number', readonly=True)
+    phone_key = fields.Char('Phone Key', readonly=True,
+                            help='Phone number normalised to international digits, for prefix search')
+    last_message_id = fields.Many2one('lipachat.message', 'Last Message', ondelete='set null', readonly=True)
+    last_message_preview = fields.Char('Last Message', readonly=True)
+    last_message_date = fields.Datetime('Last Message Date', index=True, readonly=True)
+    message_count = fields.Integer('Messages', readonly=True)
+    unread_count = fields.Integer('Unread', readonly=True,
+                                  help='Incoming messages received since the last outgoing message')
+    version = fields.Integer('Version', index=True, readonly=True,
+                             help='Increases whenever a displayed message of the conversation changes')
+
+    _sql_constraints = [
+        ('partner_config_uniq', 'unique(partner_id, config_id)',
+         'There is a single conversation per contact and configuration.'),
+    ]
+
+    def init(self):
+        # Versions are drawn from one sequence so that they never repeat, even
+        # when a conversation is rebuilt
+        self.env.cr.execute("CREATE SEQUENCE IF NOT EXISTS lipachat_conversation_version_seq")
+        # Phone search: prefix matches on the normalised number
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS lipachat_conversation_phone_key_index
+                ON lipachat_conversation (phone_key text_pattern_ops)
+        """)
+        # Backfill once, when the table is created on an existing database
+        self.env.cr.execute("SELECT 1 FROM lipachat_conversation LIMIT 1")
+        if not self.env.cr.fetchone():
+            self._recompute_conversations()
+            return
+        self.env.cr.execute("""
+            SELECT 1 FROM lipachat_conversation WHERE phone_key IS NULL AND phone_number IS NOT NULL LIMIT 1
+        """)
+        if self.env.cr.fetchone():
+            self._update_phone_keys()
+
+    @api.model
+    def _preview(self, message):
+        message_text = message.message_text or ''
+        return message_text[:50] + '...' if len(message_text) > 50 else message_text
+
+    @api.model
+    def _add_messages(self, messages):
+        """Account for newly exchanged messages with one upsert per conversation"""
+        groups = {}
+        for message in messages.sorted(lambda m: (m.create_date or fields.Datetime.now(), m.id)):
+            groups.setdefault((message.partner_id.id, message.config_id.id), []).append(message)
+
+        for (partner_id, config_id), group in groups.items():
+            last = group[-1]
+            outgoing = [m for m in group if not m.is_incoming]
+            # An outgoing message means the conversation was answered: unread restarts after it
+            unread = [m for m in group if m.is_incoming and (not outgoing or m.create_date > outgoing[-1].create_date)]
+            self.env.cr.execute("""
+                INSERT INTO lipachat_conversation AS conversation
+                       (partner_id, config_id, phone_number, last_message_id, last_message_preview,
+                        last_message_date, message_count, unread_count, version)
+                VALUES (%(partner_id)s, %(config_id)s, %(phone_number)s, %(last_message_id)s, %(preview)s,
+                        %(last_message_date)s, %(message_count)s, %(unread_count)s,
+                        nextval('lipachat_conversation_version_seq'))
+                ON CONFLICT (partner_id, config_id) DO UPDATE SET
+                       version = EXCLUDED.version,
+                       message_count = conversation.message_count + EXCLUDED.message_count,
+                       unread_count = CASE WHEN %(answered)s THEN EXCLUDED.unread_count
+                                           ELSE conversation.unread_count + EXCLUDED.unread_count END,
+                       phone_number = CASE WHEN EXCLUDED.last_message_date >= conversation.last_message_date
+                                           THEN COALESCE(EXCLUDED.phone_number, conversation.phone_number)
+                                           ELSE conversation.phone_number END,
+                       last_message_id = CASE WHEN EXCLUDED.last_message_date >= conversation.last_message_date
+                                              THEN EXCLUDED.last_message_id
+                                              ELSE conversation.last_message_id END,
+                       last_message_preview = CASE WHEN EXCLUDED.last_message_date >= conversation.last_message_date
+                                                   THEN EXCLUDED.last_message_preview
+                                                   ELSE conversation.last_message_preview END,
+                       last_message_date = GREATEST(conversation.last_message_date, EXCLUDED.last_message_date)
+            """, {
+                'partner_id': partner_id,
+                'config_id': config_id,
+                'phone_number': last.phone_number or None,
+                'last_message_id': last.id,
+                'preview': self._preview(last),
+                'last_message_date': last.create_date or fields.Datetime.now(),
+                'message_count': len(group),
+                'unread_count': len(unread),
+                'answered': bool(outgoing),
+            })
+            self.env['lipachat.read.marker']._add_unread(partner_id, len(group) - len(outgoing))
+        if groups:
+            self._update_phone_keys({partner_id for partner_id, _config_id in groups})
+            self.invalidate_model()
+
+    @api.model
+    def _recompute_conversations(self, partner_ids=None):
+        """Rebuild conversations from their messages, for all or some contacts.
+
+        Used for the initial backfill and for the rare changes that cannot be
+        applied incrementally (a message leaving a conversation).
+        """
+        self.env['lipachat.message'].flush_model()
+        partner_filter = "AND message.partner_id IN %(partner_ids)s" if partner_ids else ""
+        params = {'partner_ids': tuple(partner_ids or ())}
+        if partner_ids:
+            self.env.cr.execute(
+                "DELETE FROM lipachat_conversation WHERE partner_id IN %(partner_ids)s", params)
+        self.env.cr.execute(f"""
+            WITH stats AS (
+                SELECT message.partner_id,
+                       message.config_id,
+                       COUNT(*) AS message_count,
+                       MAX(message.create_date) FILTER (WHERE message.is_incoming IS NOT TRUE) AS last_outgoing_date
+                  FROM lipachat_message message
+                 WHERE {_CONVERSATION_MESSAGE_SQL} {partner_filter}
+              GROUP BY message.partner_id, message.config_id
+            ), latest AS (
+                SELECT DISTINCT ON (message.partner_id, message.config_id)
+                       message.partner_id, message.config_id, message.id, message.phone_number,
+                       message.message_text, message.create_date
+                  FROM lipachat_message message
+                 WHERE {_CONVERSATION_MESSAGE_SQL} {partner_filter}
+              ORDER BY message.partner_id, message.config_id, message.create_date DESC NULLS LAST, message.id DESC
+            )
+            INSERT INTO lipachat_conversation
+                   (partner_id, config_id, phone_number, last_message_id, last_message_preview,
+                    last_message_date, message_count, unread_count, version)
+            SELECT stats.partner_id,
+                   stats.config_id,
+                   NULLIF(latest.phone_number, ''),
+                   latest.id,
+                   CASE WHEN length(latest.message_text) > 50
+                        THEN left(latest.message_text, 50) || '...'
+                        ELSE COALESCE(latest.message_text, '') END,
+                   latest.create_date,
+                   stats.message_count,
+                   (SELECT COUNT(*)
+                      FROM lipachat_message message
+                     WHERE message.partner_id = stats.partner_id
+                       AND message.config_id = stats.config_id
+                       AND message.is_incoming
+                       AND {_CONVERSATION_MESSAGE_SQL}
+                       AND message.create_date > COALESCE(stats.last_outgoing_date, '-infinity')),
+                   nextval('lipachat_conversation_version_seq')
+              FROM stats
+              JOIN latest ON latest.partner_id = stats.partner_id AND latest.config_id = stats.config_id
+              JOIN res_partner partner ON partner.id = stats.partner_id
+             WHERE stats.config_id IS NOT NULL
+        """, params)
+        self._update_phone_keys(partner_ids)
+        self.invalidate_model()
+        if partner_ids:
+            self.env['lipachat.read.marker']._recompute_unread(partner_ids)
+
+    @api.model
+    def _update_phone_keys(self, partner_ids=None):
+        """Store the normalised phone number of all or some contacts' conversations.
+
+        Numbers are normalised like _normalize_phone, with the calling code
+        of each conversation's configuration.
+        """
+        partner_filter = "AND partner_id IN %(partner_ids)s" if partner_ids else ""
+        message_model = self.env['lipachat.message']
+        for config in self.env['lipachat.config'].with_context(active_test=False).search([]):
+            self.env.cr.execute(f"""
+                UPDATE lipachat_conversation
+                   SET phone_key = {_phone_key_sql('phone_number')}
+                 WHERE config_id = %(config_id)s {partner_filter}
+            """, {
+                'config_id': config.id,
+                'partner_ids': tuple(partner_ids or ()),
+                'country_code': message_model._get_phone_country_code(config) or None,
+            })
+        self.invalidate_model(['phone_key'])
+
+    @api.model
+    def _touch(self, partner_ids):
+        """Bump the version of the conversations whose displayed messages changed.
+
+        The conversations are locked before the version is drawn, so that a
+        transaction touching the same conversations and committing first
+        always holds the lower version. Returns the new version.
+        """
+        self.env.cr.execute("""
+            SELECT id FROM lipachat_conversation WHERE partner_id IN %s ORDER BY id FOR UPDATE
+        """, (tuple(partner_ids),))
+        self.env.cr.execute("SELECT nextval('lipachat_conversation_version_seq')")
+        version = self.env.cr.fetchone()[0]
+        self.env.cr.execute("""
+            UPDATE lipachat_conversation
+               SET version = %s
+             WHERE partner_id IN %s
+        """, (version, tuple(partner_ids)))
+        self.invalidate_model(['version'])
+        return version
+
+    @api.model
+    def _get_version(self, partner_id=None):
+        """Version of a contact's conversations, or of the current user's list without partner_id"""
+        if partner_id:
+            self.env.cr.execute(
+                "SELECT MAX(version) FROM lipachat_conversation WHERE partner_id = %s", (partner_id,))
+        else:
+            # The list shows the user's unread counts: their read markers version it too
+            self.env.cr.execute("""
+                SELECT GREATEST((SELECT MAX(version) FROM lipachat_conversation),
+                                (SELECT MAX(version) FROM lipachat_read_marker WHERE user_id = %s))
+            """, (self.env.uid,))
+        return self.env.cr.fetchone()[0] or 0
@@ -0,0 +1,72 @@
+from odoo import models, fields, api, _
+from datetime import timedelta
+import hashlib
+import logging
+
+_logger = logging.getLogger(__name__)
+
+class LipachatMedia(models.Model):
+    _name = 'lipachat.media'
+    _description = 'WhatsApp Uploaded Media'
+    _order = 'create_date desc'
+
+    # Days an uploaded media handle is reused before the file is uploaded
+    # again; the gateway keeps uploaded media for a limited time only
+    _media_ttl_days = 30
+
+    checksum = fields.Char('SHA-256', required=True, index=True, readonly=True)
+    config_id = fields.Many2one('lipachat.config', 'Configuration', required=True,
+                                ondelete='cascade', readonly=True)
+    media_id = fields.Char('Media ID', required=True, readonly=True)
+    file_name = fields.Char('File Name', readonly=True)
+    mime_type = fields.Char('MIME Type', readonly=True)
+    file_size = fields.Integer('Size (bytes)', readonly=True)
+    expires_at = fields.Datetime('Expires At', required=True, readonly=True)
+    hit_count = fields.Integer('Reused', default=0, readonly=True,
+                               help='Number of uploads skipped thanks to this entry')
+
+    _sql_constraints = [
+        ('checksum_config_uniq', 'unique(checksum, config_id)',
+         'A file can only be registered once per configuration.'),
+    ]
+
+    @api.model
+    def _compute_checksum(self, file_data):
+        return hashlib.sha256(file_data).hexdigest()
+
+    @api.model
+    def _lookup(self, config, checksum):
+        """Return the still valid media ID uploaded for this content, or False"""
+        media = self.search([
+            ('checksum', '=', checksum),
+            ('config_id', '=', config.id),
+            ('expires_at', '>', fields.Datetime.now()),
+        ], limit=1)
+        if not media:
+            return False
+        media.hit_count += 1
+        _logger.info(f"Reusing uploaded media {media.media_id} for {media.file_name or checksum}")
+        return media.media_id
+
+    @api.model
+    def _register(self, config, checksum, media_id, file_name=False, mime_type=False, file_size=0):
+        """Remember the media ID the gateway returned for this content"""
+        vals = {
+            'media_id': media_id,
+            'file_name': file_name,
+            'mime_type': mime_type,
+            'file_size': file_size,
+            'expires_at': fields.Datetime.now() + timedelta(days=self._media_ttl_days),
+        }
+        media = self.search([('checksum', '=', checksum), ('config_id', '=', config.id)], limit=1)
+        if media:
+            media.write(vals)
+        else:
+            vals.update({'checksum': checksum, 'config_id': config.id})
+            media = self.create(vals)
+        return media
+
+    @api.autovacuum
+    def _gc_expired_media(self):
+        """Drop registry entries whose media the gateway no longer keeps"""
+        self.search([('expires_at', '<=', fields.Datetime.now())]).unlink()
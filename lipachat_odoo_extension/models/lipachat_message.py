@@ -7,15 +7,80 @@ import json
 import uuid
 import logging
 import re
+import time
+import functools
+
+from .lipachat_config import GatewayUnavailableError
 
 _logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=65536)
+def _normalize_phone(phone, country_code=False):
+    """Return phone as E.164 digits without '+', or False if it cannot be valid.
+
+    National numbers (trunk prefix '0', or too short to carry a country code)
+    are expanded with country_code; '+' and '00' prefixes mark numbers that
+    are already international.
+    """
+    if not phone or not isinstance(phone, str):
+        return False
+    phone = phone.strip()
+    digits = re.sub(r'[^\d]', '', phone)
+    if phone.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        if not country_code:
+            return False
+        digits = country_code + digits[1:]
+    elif country_code and len(digits) <= 10 and not digits.startswith(country_code):
+        digits = country_code + digits
+
+    # E.164 allows at most 15 digits and country codes never start with 0
+    if not 8 <= len(digits) <= 15 or digits.startswith('0'):
+        return False
+    return digits
+
+# Dispatch lanes, highest priority first
+DISPATCH_LANES = [
+    ('transactional', 'Transactional'),
+    ('utility', 'Utility'),
+    ('marketing', 'Marketing'),
+]
+
+# Lane of the messages sent with a template of each category
+_CATEGORY_LANES = {
+    'AUTHENTICATION': 'transactional',
+    'UTILITY': 'utility',
+    'MARKETING': 'marketing',
+}
+
+# Marker values replaced by per-recipient data in compiled template payloads
+_PAYLOAD_SLOT = '\x00%s\x00'
+_PAYLOAD_SLOT_RE = re.compile(r'"\\u0000(\w+)\\u0000"')
+
+# Bus channel the chat interface listens on, and the fields whose changes it displays
+CHAT_BUS_CHANNEL = 'lipachat_chat'
+_CHAT_FIELDS = {'state', 'partner_id', 'config_id', 'is_bulk_template', 'message_text', 'caption', 'media_url'}
+
 class LipachatMessage(models.Model):
     _name = 'lipachat.message'
     _description = 'WhatsApp Messages'
     _order = 'create_date desc'
     _rec_name = 'message_id'
 
+    # Share of the dispatch time each lane is guaranteed while it has work
+    _dispatch_lane_shares = {
+        'transactional': 0.6,
+        'utility': 0.3,
+        'marketing': 0.1,
+    }
+
+    # Scheduled messages are claimed and sent one per transaction, for at most
+    # this many seconds per cron run
+    _scheduled_time_budget = 60
+
     message_id = fields.Char('Message ID', required=True, default=lambda self: str(uuid.uuid4()))
     partner_id = fields.Many2one('res.partner', 'Contact', help='Select a contact to send this message to')
     view_phone_number = fields.Char('Contact Phone')
@@ -24,7 +89,18 @@ class LipachatMessage(models.Model):
     
     # Add field to track if this is a bulk message template
     is_bulk_template = fields.Boolean('Is Bulk Template', default=False)
-    bulk_parent_id = fields.Many2one('lipachat.message', 'Bulk Parent Message')
+    bulk_parent_id = fields.Many2one('lipachat.message', 'Bulk Parent Message', index=True)
+    campaign_id = fields.Many2one('lipachat.campaign', 'Campaign', index=True, readonly=True)
+    chat_version = fields.Integer('Chat Version', readonly=True, copy=False,
+                                  help='Conversation version at which the message last changed in the chat')
+    
+    # Dispatch priority: OTP and utility traffic must not queue behind marketing
+    dispatch_priority = fields.Selection(DISPATCH_LANES, 'Priority',
+                                         help='Overrides the lane derived from the template category')
+    dispatch_lane = fields.Selection(DISPATCH_LANES, 'Dispatch Lane', compute='_compute_dispatch_lane',
+                                     store=True, index=True)
+    scheduled_at = fields.Datetime('Scheduled At', index=True, copy=False,
+                                   help='Send the message from this date instead of right away')
     
     # Add fields for incoming messages
     is_incoming = fields.Boolean('Is Incoming Message', default=False)
@@ -80,11 +156,13 @@ class LipachatMessage(models.Model):
     # Status fields
     state = fields.Selection([
         ('DRAFT', 'DRAFT'),
+        ('SCHEDULED', 'SCHEDULED'),
         ('SENT', 'SENT'),
         ('DELIVERED', 'DELIVERED'),
         ('READ', 'READ'),
         ('FAILED', 'FAILED'),
         ('RECEIVED', 'RECEIVED'),
+        ('partially_sent', 'PARTIALLY SENT'),
     ], string='Status', default='DRAFT')
 
     direction = fields.Selection([
@@ -97,6 +175,16 @@ class LipachatMessage(models.Model):
     sent_contacts = fields.Text('Sent To', readonly=True)
     failed_contacts = fields.Text('Failed To', readonly=True)
     
+    # Delivery statistics of a bulk template, aggregated from its child messages
+    bulk_total_count = fields.Integer('Recipients', readonly=True, copy=False)
+    bulk_queued_count = fields.Integer('Queued', readonly=True, copy=False)
+    bulk_sent_count = fields.Integer('Sent', readonly=True, copy=False,
+                                     help='Messages accepted by the gateway, including delivered and read ones')
+    bulk_delivered_count = fields.Integer('Delivered', readonly=True, copy=False,
+                                          help='Messages delivered to the handset, including read ones')
+    bulk_read_count = fields.Integer('Read', readonly=True, copy=False)
+    bulk_failed_count = fields.Integer('Failed', readonly=True, copy=False)
+    
     # Computed field for truncated message display
     message_text_short = fields.Char('Content Preview', compute='_compute_message_text_short', store=False)
 
@@ -173,7 +261,8 @@ class LipachatMessage(models.Model):
             page_size = 100  # Maximum page size to reduce number of requests
             
             # First request to get total pages without parameters
-            initial_response = requests.get(
+            initial_response = config._gateway_request(
+                'get',
                 f"{config.api_base_url}/whatsapp/message",
                 headers=headers,
                 timeout=30
@@ -198,7 +287,8 @@ class LipachatMessage(models.Model):
                     'size': page_size
                 }
                 
-                response = requests.get(
+                response = config._gateway_request(
+                    'get',
                     f"{config.api_base_url}/whatsapp/message",
                     headers=headers,
                     params=params,
@@ -293,6 +383,7 @@ class LipachatMessage(models.Model):
         
         _logger.info(f"Processing {fetched_count} messages")
         
+        bulk_templates = self.browse()
         for msg_data in messages:
             try:
                 # Skip if no message ID
@@ -307,6 +398,7 @@ class LipachatMessage(models.Model):
                     # Update existing message status if needed
                     _logger.debug(f"Updating existing message {msg_data.get('id')}")
                     self._update_existing_message(existing_msg, msg_data)
+                    bulk_templates |= existing_msg.bulk_parent_id
                 else:
                     # Create new message record
                     _logger.debug(f"Creating new message {msg_data.get('id')}")
@@ -317,6 +409,9 @@ class LipachatMessage(models.Model):
                 _logger.error(f"Error processing message {msg_data.get('id', 'unknown')}: {str(e)}")
                 continue
         
+        # Delivery and read receipts change the statistics of their bulk templates
+        bulk_templates._update_bulk_counters()
+        
         _logger.info(f"Processed {fetched_count} messages, {new_count} new messages added")
         return fetched_count, new_count
     
@@ -412,7 +507,7 @@ class LipachatMessage(models.Model):
             # Find or create partner
             partner_id = False
             if phone_number:
-                phone_clean = self._clean_phone_number(phone_number)
+                phone_clean = self._clean_phone_number(phone_number, config)
                 partner = self._find_or_create_partner(phone_clean, username)
                 partner_id = partner.id if partner else False
             
@@ -483,7 +578,10 @@ class LipachatMessage(models.Model):
             create_date = vals_without_timestamps.pop('create_date')
             write_date = vals_without_timestamps.pop('write_date')
 
-            record = self.create(vals_without_timestamps)
+            record = self.with_context(lipachat_defer_conversation=True).create(vals_without_timestamps)
+            if is_incoming:
+                # An inbound message opens a session window for the contact
+                self.env['lipachat.contact.session']._invalidate(config, phone_number)
 
              # Then update the timestamps directly in the database
             # This bypasses Odoo's ORM restrictions on system fields
@@ -496,6 +594,10 @@ class LipachatMessage(models.Model):
             # Invalidate cache to ensure the updated values are reflected
             record.invalidate_model(['create_date', 'write_date'])
             
+            # Only now is the message dated as on the gateway
+            if record._is_conversation_message():
+                self.env['lipachat.conversation']._add_messages(record)
+            
             _logger.debug(f"Updated message {record.id} with create_date: {create_date}, write_date: {write_date}")
         
         
@@ -646,6 +748,150 @@ class LipachatMessage(models.Model):
                 record.view_phone_number = False
                 record.phone_number = False
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        messages = super().create(vals_list)
+        conversation_messages = messages.filtered(lambda m: m._is_conversation_message())
+        if not self.env.context.get('lipachat_defer_conversation'):
+            self.env['lipachat.conversation']._add_messages(conversation_messages)
+        conversation_messages._notify_chat_update()
+        return messages
+
+    def write(self, vals):
+        if not {'state', 'partner_id', 'config_id', 'is_bulk_template'}.intersection(vals):
+            result = super().write(vals)
+            if _CHAT_FIELDS.intersection(vals):
+                self.filtered(lambda m: m._is_conversation_message())._notify_chat_update()
+            return result
+
+        # Keep the conversations in step: count messages entering them, rebuild the
+        # (rare) conversations a message leaves or moves out of
+        before = self.filtered(lambda m: m._is_conversation_message())
+        if 'partner_id' in vals:
+            # The conversation the messages leave changes as well
+            before._notify_chat_update()
+        result = super().write(vals)
+        after = self.filtered(lambda m: m._is_conversation_message())
+
+        conversations = self.env['lipachat.conversation']
+        if 'partner_id' in vals or 'config_id' in vals:
+            rebuilt = before | after
+        else:
+            rebuilt = before - after
+        if rebuilt:
+            conversations._recompute_conversations(rebuilt.partner_id.ids)
+        conversations._add_messages((after - before).filtered(lambda m: m.partner_id not in rebuilt.partner_id))
+        # Drafts, scheduled, failed and bulk template messages never show in the chat
+        (before | after)._notify_chat_update()
+        return result
+
+    def _notify_chat_update(self):
+        """Tell the open chat interfaces that these messages' conversations changed.
+
+        Messages and contacts are collected until the transaction commits, so
+        that a sync or bulk send bumps the conversations' versions and
+        publishes a bus notification only once. Callers only pass messages
+        the chat displays, before or after their change. With the
+        lipachat_defer_chat_notify context key the bus notification is left
+        to the caller (see _notify_chat_clients), e.g. once per campaign chunk.
+        """
+        messages = self.filtered('partner_id')
+        if not messages:
+            return
+        data = self.env.cr.precommit.data
+        if 'lipachat.chat.partner_ids' not in data:
+            data['lipachat.chat.partner_ids'] = set()
+            data['lipachat.chat.message_ids'] = set()
+            self.env.cr.precommit.add(self.env['lipachat.message']._send_chat_update)
+        data['lipachat.chat.partner_ids'].update(messages.partner_id.ids)
+        data['lipachat.chat.message_ids'].update(messages.ids)
+
+    @api.model
+    def _send_chat_update(self):
+        data = self.env.cr.precommit.data
+        partner_ids = data.pop('lipachat.chat.partner_ids', None)
+        message_ids = data.pop('lipachat.chat.message_ids', None)
+        if not partner_ids:
+            return
+        # Stamped right before the commit with the new conversation version:
+        # chat polls fetch the messages changed since the version they hold
+        version = self.env['lipachat.conversation']._touch(partner_ids)
+        self.env.cr.execute("""
+            UPDATE lipachat_message SET chat_version = %s WHERE id IN %s
+        """, (version, tuple(message_ids)))
+        self.invalidate_model(['chat_version'])
+        if not self.env.context.get('lipachat_defer_chat_notify'):
+            self._notify_chat_clients(partner_ids)
+
+    @api.model
+    def _notify_chat_clients(self, partner_ids):
+        """Publish a single bus notification for the conversations of partner_ids"""
+        if partner_ids:
+            self.env['bus.bus']._sendone(CHAT_BUS_CHANNEL, 'lipachat.chat/updated', {
+                'partner_ids': sorted(partner_ids),
+            })
+
+    def _is_conversation_message(self):
+        """True once the message was exchanged with a contact and shows in the chat"""
+        self.ensure_one()
+        return bool(self.partner_id) and not self.is_bulk_template and self.state not in ('FAILED', 'DRAFT', 'SCHEDULED')
+
+    def init(self):
+        # Conversation list and history: latest messages of a partner first
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS lipachat_message_partner_create_date_index
+                ON lipachat_message (partner_id, create_date DESC, id DESC)
+             WHERE partner_id IS NOT NULL
+        """)
+        # Chat polls: messages of a partner changed since a conversation version
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS lipachat_message_partner_chat_version_index
+                ON lipachat_message (partner_id, chat_version)
+             WHERE partner_id IS NOT NULL
+        """)
+        # Message search: trigram indexes serve ILIKE '%...%' on the texts
+        if not self._has_trigram():
+            try:
+                with self.env.cr.savepoint():
+                    self.env.cr.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            except Exception as e:
+                _logger.warning(f"pg_trgm is not available, message search will not be indexed: {str(e)}")
+                return
+        for column in ('message_text', 'caption'):
+            self.env.cr.execute(f"""
+                CREATE INDEX IF NOT EXISTS lipachat_message_{column}_trgm_index
+                    ON lipachat_message USING gin ({column} gin_trgm_ops)
+            """)
+
+    @api.model
+    def _has_trigram(self):
+        self.env.cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return bool(self.env.cr.fetchone())
+
+    @api.depends('dispatch_priority', 'message_type', 'template_name.category')
+    def _compute_dispatch_lane(self):
+        for record in self:
+            if record.dispatch_priority:
+                record.dispatch_lane = record.dispatch_priority
+            elif record.message_type == 'template' and record.template_name:
+                record.dispatch_lane = _CATEGORY_LANES.get(record.template_name.category, 'marketing')
+            else:
+                record.dispatch_lane = 'utility'
+
+    @api.model
+    def _pick_dispatch_lane(self, lanes, spent):
+        """Return the lane to serve next among the lanes that have work queued.
+
+        Each lane is entitled to its share of the dispatch time; the lane that
+        used the least of its share goes next and ties go to the higher
+        priority lane, so an idle lane's share is spent by the others.
+        """
+        shares = self._dispatch_lane_shares
+        candidates = [lane for lane, _label in DISPATCH_LANES if lane in lanes]
+        if not candidates:
+            return False
+        return min(candidates, key=lambda lane: spent.get(lane, 0.0) / shares[lane])
+
     @api.depends('template_name')
     def _compute_template_variables(self):
         for record in self:
@@ -656,6 +902,84 @@ class LipachatMessage(models.Model):
             else:
                 record.template_variables = '[]'
 
+    def _get_template_placeholders(self):
+        """Return the template placeholder values of this message as a list of strings"""
+        try:
+            # Get placeholders - handle both string JSON and direct values
+            placeholders = []
+            if self.template_placeholders:
+                # First try to parse as JSON
+                try:
+                    parsed = json.loads(self.template_placeholders)
+                    if isinstance(parsed, list):
+                        placeholders = parsed
+                    else:
+                        placeholders = [parsed]
+                except json.JSONDecodeError:
+                    # If not valid JSON, treat as direct string value
+                    placeholders = [self.template_placeholders]
+            
+            # Convert all placeholders to strings without extra escaping
+            sanitized_placeholders = []
+            for placeholder in placeholders:
+                if placeholder is None:
+                    sanitized_placeholders.append("")
+                else:
+                    # Convert to string without adding extra quotes
+                    sanitized_placeholders.append(str(placeholder))
+            return sanitized_placeholders
+            
+        except Exception as e:
+            _logger.error(f"Error processing template placeholders: {str(e)}")
+            raise ValidationError(_("Invalid template placeholder values. Please check your input."))
+
+    def _compile_template_payload(self, config):
+        """Serialise the static part of this template message's payload once.
+
+        The payload is sent from config, the sender whose API key sends it:
+        campaigns compile one payload per number of their sender pool.
+        Returns a tuple (segments, placeholders_raw, placeholders_json) where
+        segments alternates literal JSON fragments and slot names, filled in
+        per recipient by _render_compiled_payload().
+        """
+        self.ensure_one()
+        components = self._prepare_template_components()
+        placeholders = components.get('body', {}).get('placeholders')
+        if placeholders is not None:
+            components['body']['placeholders'] = _PAYLOAD_SLOT % 'placeholders'
+        
+        data = {
+            "messageId": _PAYLOAD_SLOT % 'messageId',
+            "to": _PAYLOAD_SLOT % 'to',
+            "from": config.default_from_number,
+            "template": {
+                "name": self.template_name.name,
+                "languageCode": "en",
+                "components": components
+            }
+        }
+        payload = json.dumps(data)
+        _logger.debug("Compiled template payload: %s", payload)
+        
+        segments = tuple(_PAYLOAD_SLOT_RE.split(payload))
+        return segments, self.template_placeholders, json.dumps(placeholders)
+
+    def _render_compiled_payload(self, compiled, recipient):
+        """Splice the per-recipient values into a payload from _compile_template_payload()"""
+        segments, placeholders_raw, placeholders_json = compiled
+        if self.template_placeholders == placeholders_raw:
+            placeholders = placeholders_json
+        else:
+            placeholders = json.dumps(self._get_template_placeholders())
+        values = {
+            'messageId': json.dumps(self.message_id),
+            'to': json.dumps(recipient['phone']),
+            'placeholders': placeholders,
+        }
+        parts = list(segments)
+        parts[1::2] = [values[slot] for slot in segments[1::2]]
+        return ''.join(parts)
+
     def _prepare_template_components(self):
         """Prepare the components dictionary for template messages"""
         components = {}
@@ -669,38 +993,11 @@ class LipachatMessage(models.Model):
         
         # Handle body components
         if self.template_variables:
-            try:
-                # Get placeholders - handle both string JSON and direct values
-                placeholders = []
-                if self.template_placeholders:
-                    # First try to parse as JSON
-                    try:
-                        parsed = json.loads(self.template_placeholders)
-                        if isinstance(parsed, list):
-                            placeholders = parsed
-                        else:
-                            placeholders = [parsed]
-                    except json.JSONDecodeError:
-                        # If not valid JSON, treat as direct string value
-                        placeholders = [self.template_placeholders]
-                
-                # Convert all placeholders to strings without extra escaping
-                sanitized_placeholders = []
-                for placeholder in placeholders:
-                    if placeholder is None:
-                        sanitized_placeholders.append("")
-                    else:
-                        # Convert to string without adding extra quotes
-                        sanitized_placeholders.append(str(placeholder))
-                
-                if sanitized_placeholders:
-                    components['body'] = {
-                        'placeholders': sanitized_placeholders
-                    }
-                
-            except Exception as e:
-                _logger.error(f"Error processing template placeholders: {str(e)}")
-                raise ValidationError(_("Invalid template placeholder values. Please check your input."))
+            sanitized_placeholders = self._get_template_placeholders()
+            if sanitized_placeholders:
+                components['body'] = {
+                    'placeholders': sanitized_placeholders
+                }
                 
         return components
 
@@ -726,6 +1023,8 @@ class LipachatMessage(models.Model):
     @api.constrains('partner_id', 'phone_number')
     def _check_recipients(self):
         for record in self:
+            if record.is_bulk_template:
+                continue  # Recipients of bulk templates live on the individual messages
             if not record.partner_id and not record.phone_number:
                 raise ValidationError(_("You must specify either a contact or a phone number"))
     
@@ -735,16 +1034,41 @@ class LipachatMessage(models.Model):
             if record.message_type == 'text' and not record.message_text:
                 raise ValidationError(_("Message text is required for text messages"))
             
-    def _clean_phone_number(self, phone):
-        """Remove all non-digit characters from phone number"""
+    def _clean_phone_number(self, phone, config=None):
+        """Normalise a phone number to international digits (E.164 without '+')"""
         if not phone:
             return phone
-        # Remove all non-digit characters
-        cleaned = re.sub(r'[^\d]', '', phone)
-        # Remove leading 0 if present (for Kenya numbers)
-        if cleaned.startswith('0'):
-            cleaned = cleaned[1:]
-        return cleaned
+        country_code = self._get_phone_country_code(config)
+        # Fall back to the bare digits when the number cannot be normalised
+        return _normalize_phone(phone, country_code) or re.sub(r'[^\d]', '', phone)
+
+    def _get_phone_country_code(self, config=None):
+        """Return the calling code used to expand national numbers, e.g. '254'"""
+        config = config or self.config_id[:1] or self.env['lipachat.config'].search([('active', '=', True)], limit=1)
+        phone_code = config.default_country_id.phone_code
+        return str(phone_code) if phone_code else False
+
+    def _normalize_recipients(self, recipients, config=None):
+        """Clean, validate and deduplicate a whole recipient list in one pass.
+
+        Returns (valid, invalid): valid recipients carry their E.164 number,
+        invalid ones are returned untouched so they can be reported without
+        ever reaching the gateway.
+        """
+        country_code = self._get_phone_country_code(config)
+        valid = []
+        invalid = []
+        seen = set()
+        for recipient in recipients:
+            phone = _normalize_phone(recipient.get('phone'), country_code)
+            if not phone:
+                invalid.append(recipient)
+                continue
+            if phone in seen:
+                continue
+            seen.add(phone)
+            valid.append(dict(recipient, phone=phone))
+        return valid, invalid
 
     def send_message(self):
         """Send WhatsApp message via LipaChat API to one contact"""
@@ -759,13 +1083,13 @@ class LipachatMessage(models.Model):
             if not phone:
                 raise ValidationError(_("Selected contact doesn't have a phone number"))
             recipient = {
-                'phone': self._clean_phone_number(phone),
+                'phone': phone,
                 'name': self.partner_id.name,
                 'partner_id': self.partner_id.id
             }
         elif self.phone_number:
             recipient = {
-                'phone': self._clean_phone_number(self.phone_number),
+                'phone': self.phone_number,
                 'name': self.phone_number,
                 'partner_id': False
             }
@@ -773,17 +1097,117 @@ class LipachatMessage(models.Model):
         if not recipient:
             raise ValidationError(_("No valid recipient found. Please check phone number."))
         
+        valid, invalid = self._normalize_recipients([recipient], config)
+        if invalid:
+            raise ValidationError(_("Invalid phone number: %s") % recipient['phone'])
+        recipient = valid[0]
+        
         return self._send_single_message(recipient, config)
 
+    def action_schedule(self):
+        """Queue the message for the scheduled dispatcher instead of sending it now"""
+        for record in self:
+            if record.state != 'DRAFT':
+                raise UserError(_("Only draft messages can be scheduled."))
+            if not record.scheduled_at:
+                raise ValidationError(_("Please set the date at which the message must be sent."))
+            if record.scheduled_at <= fields.Datetime.now():
+                raise ValidationError(_("The scheduled date must be in the future."))
+            if not record.config_id:
+                raise ValidationError(_("Please select a valid LipaChat configuration."))
+        self.write({'state': 'SCHEDULED'})
+        return True
+
+    def action_unschedule(self):
+        self.filtered(lambda m: m.state == 'SCHEDULED').write({'state': 'DRAFT'})
+        return True
+
+    def _claim_due_messages(self, limit):
+        """Lock and return due scheduled messages, highest priority lane first.
+
+        SKIP LOCKED lets several cron workers claim disjoint messages; the
+        locks are held until the claiming transaction is committed.
+        """
+        self.flush_model(['state', 'scheduled_at', 'dispatch_lane'])
+        self.env.cr.execute("""
+            SELECT id
+              FROM lipachat_message
+             WHERE state = 'SCHEDULED'
+               AND scheduled_at <= %s
+          ORDER BY CASE dispatch_lane
+                        WHEN 'transactional' THEN 0
+                        WHEN 'utility' THEN 1
+                        ELSE 2
+                   END,
+                   scheduled_at, id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, (fields.Datetime.now(), limit))
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _dispatch_scheduled_message(self):
+        """Send a claimed scheduled message.
+
+        Returns False when the gateway is unavailable; the message is then
+        kept scheduled and retried by a later run.
+        """
+        self.ensure_one()
+        self.state = 'DRAFT'
+        try:
+            with self.env.cr.savepoint():
+                self.send_message()
+        except Exception as e:
+            _logger.error(f"Failed to send scheduled message {self.id}: {str(e)}")
+            self.invalidate_recordset()
+            self.write({'state': 'FAILED', 'error_message': str(e), 'fail_reason': str(e)})
+            return True
+
+        if self.state == 'DRAFT':
+            if self.config_id._circuit_is_open():
+                self.state = 'SCHEDULED'
+                return False
+            fail_reason = _("Message was not accepted by the gateway")
+            self.write({'state': 'FAILED', 'error_message': fail_reason, 'fail_reason': fail_reason})
+        return True
+
+    @api.model
+    def _cron_dispatch_scheduled(self):
+        """Send due scheduled messages one by one, one transaction per message.
+
+        Each message is committed right after its send, so a worker killed
+        mid-run never sends a message the gateway already accepted again.
+        """
+        deadline = time.monotonic() + self._scheduled_time_budget
+        while time.monotonic() < deadline:
+            message = self._claim_due_messages(1)
+            if not message:
+                return True
+            gateway_available = message._dispatch_scheduled_message()
+            self.env.cr.commit()
+            if not gateway_available:
+                _logger.warning("Gateway unavailable, scheduled messages will be retried in the next run")
+                return True
+
+        _logger.info("Scheduled dispatch time budget used, continuing in next run")
+        cron = self.env.ref('lipachat_odoo_extension.ir_cron_dispatch_scheduled_messages', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+        return True
+
     def _send_bulk_messages(self, recipients, config):
         """Create individual message records for each recipient and send them"""
         # Mark current record as bulk template only if more than one recipient
         if not config.api_key:
             raise ValidationError(_("Please configure you API key before sending messages."))
         
-        if len(recipients) > 1:
+        # Reject invalid numbers up front, they never cost a gateway call
+        recipients, invalid = self._normalize_recipients(recipients, config)
+        
+        if len(recipients) + len(invalid) > 1:
             self.is_bulk_template = True
         else:
+            if invalid:
+                raise ValidationError(_("Invalid phone number: %s") % invalid[0]['phone'])
             # For single recipient, update current record with recipient info
             recipient = recipients[0]
             self.partner_id = recipient['partner_id'] if recipient['partner_id'] else False
@@ -791,37 +1215,39 @@ class LipachatMessage(models.Model):
             # Send directly without creating a copy
             return self._send_single_message(recipient, config)
         
-        self.state = 'draft'  # Keep template as draft
+        self.state = 'DRAFT'  # Keep template as draft
         
-        individual_messages = []
+        # Contacts outside their session window would only bounce a free-form message
+        recipients, needs_template = self._preflight_session_check(recipients, config)
         
-        for recipient in recipients:
-            # Create individual message record
-            individual_msg = self.copy({
-                'partner_id': recipient['partner_id'],
-                'phone_number': recipient['phone'],
-                'is_bulk_template': False,
-                'bulk_parent_id': self.id,
-                'message_id': str(uuid.uuid4()),  # New unique ID
-            })
-            individual_messages.append(individual_msg)
+        # Build every individual message in memory and insert them in one batch
+        individual_messages = self.create(self._prepare_bulk_vals_list(recipients))
+        invalid_messages = self.create(
+            self._prepare_bulk_vals_list(invalid, fail_reason=_("Invalid phone number"))
+            + self._prepare_bulk_vals_list(needs_template, fail_reason=self._no_session_fail_reason())
+        )
+        
+        if self.message_type == 'template':
+            compiled = self._compile_template_payload(config)
+            individual_messages = individual_messages.with_context(lipachat_compiled_payload=compiled)
         
         # Send each individual message
+        partner_names = self._get_recipient_partner_names(recipients)
         success_count = 0
-        for msg in individual_messages:
+        for msg, recipient in zip(individual_messages, recipients):
             try:
                 recipient = {
-                    'phone': msg.phone_number,
-                    'name': msg.partner_id.name if msg.partner_id else msg.phone_number,
-                    'partner_id': msg.partner_id.id if msg.partner_id else False
+                    'phone': recipient['phone'],
+                    'name': recipient.get('name') or partner_names.get(recipient['partner_id']) or recipient['phone'],
+                    'partner_id': recipient['partner_id'] or False
                 }
-                if msg._send_single_message(recipient, config):
+                if msg._send_single_message(recipient, config) is True:
                     success_count += 1
             except Exception as e:
                 _logger.error(f"Failed to send individual message {msg.id}: {str(e)}")
         
         # Update bulk template status
-        total_messages = len(individual_messages)
+        total_messages = len(individual_messages) + len(invalid_messages)
         if success_count == total_messages:
             self.state = 'SENT'
         elif success_count == 0:
@@ -829,15 +1255,126 @@ class LipachatMessage(models.Model):
         else:
             self.state = 'partially_sent'
         
-        # Update summary fields on template
-        sent_contacts = [msg.partner_id.name or msg.phone_number for msg in individual_messages if msg.state == 'SENT']
-        failed_contacts = [f"{msg.partner_id.name or msg.phone_number}: {msg.error_message}" for msg in individual_messages if msg.state == 'FAILED']
-        
-        self.sent_contacts = ', '.join(sent_contacts) if sent_contacts else ''
-        self.failed_contacts = '\n'.join(failed_contacts) if failed_contacts else ''
+        # Per-recipient details stay on the child messages, the template only keeps counters
+        self._update_bulk_counters()
         
         return True
 
+    def _preflight_session_check(self, recipients, config):
+        """Split recipients into those who can receive this message and those who need a template.
+
+        Only template messages may be sent outside the 24-hour session window.
+        Sessions are checked for the whole list at once (cached answers first,
+        the rest concurrently); contacts whose session could not be checked
+        are kept, the gateway remains the final judge for them.
+        """
+        if self.message_type == 'template' or not recipients:
+            return recipients, []
+
+        sessions = self.env['lipachat.contact.session']._check_sessions(config, [r['phone'] for r in recipients])
+        eligible = []
+        needs_template = []
+        for recipient in recipients:
+            session_info = sessions.get(recipient['phone'], {})
+            if session_info.get('session_active') or not session_info.get('checked', True):
+                eligible.append(recipient)
+            else:
+                needs_template.append(recipient)
+        if needs_template:
+            _logger.info(f"{len(needs_template)} of {len(recipients)} recipients have no active session")
+        return eligible, needs_template
+
+    def _no_session_fail_reason(self):
+        return _("No active session: send a template message to this contact first")
+
+    def _update_bulk_counters(self):
+        """Refresh the delivery statistics of bulk templates with one aggregate query"""
+        if not self.ids:
+            return
+        self.flush_model(['bulk_parent_id', 'state'])
+        self.env.cr.execute("""
+            SELECT bulk_parent_id,
+                   COUNT(*),
+                   COUNT(*) FILTER (WHERE state = 'DRAFT'),
+                   COUNT(*) FILTER (WHERE state IN ('SENT', 'DELIVERED', 'READ')),
+                   COUNT(*) FILTER (WHERE state IN ('DELIVERED', 'READ')),
+                   COUNT(*) FILTER (WHERE state = 'READ'),
+                   COUNT(*) FILTER (WHERE state = 'FAILED')
+              FROM lipachat_message
+             WHERE bulk_parent_id IN %s
+          GROUP BY bulk_parent_id
+        """, (tuple(self.ids),))
+        stats = {row[0]: row[1:] for row in self.env.cr.fetchall()}
+
+        for template in self:
+            total, queued, sent, delivered, read, failed = stats.get(template.id, (0, 0, 0, 0, 0, 0))
+            template.write({
+                'bulk_total_count': total,
+                'bulk_queued_count': queued,
+                'bulk_sent_count': sent,
+                'bulk_delivered_count': delivered,
+                'bulk_read_count': read,
+                'bulk_failed_count': failed,
+            })
+
+    def action_view_bulk_messages(self):
+        """Open the child messages of a bulk template, optionally filtered by status"""
+        self.ensure_one()
+        domain = [('bulk_parent_id', '=', self.id)]
+        states = self.env.context.get('bulk_states')
+        if states:
+            domain.append(('state', 'in', states))
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Bulk Messages'),
+            'res_model': 'lipachat.message',
+            'view_mode': 'tree,form',
+            'domain': domain,
+            'context': {'create': False},
+        }
+
+    def _prepare_bulk_vals_list(self, recipients, fail_reason=None):
+        """Build the create() values of the individual messages of a bulk send.
+
+        The template record is read once through copy_data(); each recipient
+        only overrides the fields that differ between the copies. With a
+        fail_reason the messages are created as failed and never dispatched.
+        """
+        base_vals = self.copy_data({
+            'is_bulk_template': False,
+            'bulk_parent_id': self.id,
+            'state': 'DRAFT',
+            'sent_contacts': False,
+            'failed_contacts': False,
+            'response_data': False,
+            'error_message': False,
+        })[0]
+        
+        vals_list = []
+        for recipient in recipients:
+            vals = dict(base_vals)
+            vals.update({
+                'partner_id': recipient['partner_id'] or False,
+                'phone_number': recipient['phone'],
+                'message_id': str(uuid.uuid4()),  # New unique ID
+            })
+            if fail_reason:
+                vals.update({
+                    'state': 'FAILED',
+                    'error_message': fail_reason,
+                    'fail_reason': fail_reason,
+                })
+            vals_list.append(vals)
+        return vals_list
+
+    def _get_recipient_partner_names(self, recipients):
+        """Read the names of all recipient partners in a single query"""
+        partner_ids = list({r['partner_id'] for r in recipients if r.get('partner_id')})
+        if not partner_ids:
+            return {}
+        partners = self.env['res.partner'].browse(partner_ids).read(['name'])
+        return {partner['id']: partner['name'] for partner in partners}
+
     def _send_single_message(self, recipient, config):
         if not config.api_key:
             raise ValidationError(_("Please configure your API key before sending messages."))
@@ -859,6 +1396,7 @@ class LipachatMessage(models.Model):
                 if result.get('status', False):
                     self.state = 'SENT'
                     self.sent_contacts = f"{recipient['name']} ({recipient['phone']})"
+                    self._invalidate_contact_session(config, recipient['phone'])
                     return True
                 else:
                     return False
@@ -866,6 +1404,7 @@ class LipachatMessage(models.Model):
             if result:
                 self.state = 'SENT'
                 self.sent_contacts = f"{recipient['name']} ({recipient['phone']})"
+                self._invalidate_contact_session(config, recipient['phone'])
                 return True
             
             else:
@@ -880,6 +1419,21 @@ class LipachatMessage(models.Model):
                 })
                 return False
                 
+        except GatewayUnavailableError as e:
+            # Fail fast without a gateway round trip; the message stays queued
+            _logger.warning(f"Not sending to {recipient['phone']}: {str(e)}")
+            self.error_message = str(e)
+            return {
+                'type': 'ir.actions.client',
+                'tag': 'display_notification',
+                'params': {
+                    'title': _("Gateway Unavailable"),
+                    'message': str(e),
+                    'type': 'warning',
+                    'sticky': False,
+                }
+            }
+
         except Exception as e:
             fail_reason = str(e)
             _logger.error(f"Failed to send to {recipient['phone']}: {fail_reason}")
@@ -892,6 +1446,11 @@ class LipachatMessage(models.Model):
         
 
     
+    def _invalidate_contact_session(self, config, phone):
+        """Template sends open a new session window: drop the cached session state"""
+        if self.message_type == 'template':
+            self.env['lipachat.contact.session']._invalidate(config, phone)
+
     def _send_text_message(self, config, headers, recipient):
         data = {
             "message": self.message_text,
@@ -900,7 +1459,8 @@ class LipachatMessage(models.Model):
             "from": self.from_number or config.default_from_number
         }
         
-        response = requests.post(
+        response = config._gateway_request(
+            'post',
             f"{config.api_base_url}/whatsapp/message/text",
             headers=headers,
             json=data,
@@ -919,7 +1479,8 @@ class LipachatMessage(models.Model):
             "caption": self.caption or ""
         }
         
-        response = requests.post(
+        response = config._gateway_request(
+            'post',
             f"{config.api_base_url}/whatsapp/media",
             headers=headers,
             json=data,
@@ -939,7 +1500,8 @@ class LipachatMessage(models.Model):
             "from": self.from_number or config.default_from_number
         }
         
-        response = requests.post(
+        response = config._gateway_request(
+            'post',
             f"{config.api_base_url}/whatsapp/interactive/buttons",
             headers=headers,
             json=data,
@@ -961,7 +1523,8 @@ class LipachatMessage(models.Model):
             "from": self.from_number or config.default_from_number
         }
         
-        response = requests.post(
+        response = config._gateway_request(
+            'post',
             f"{config.api_base_url}/whatsapp/interactive/list",
             headers=headers,
             json=data,
@@ -971,6 +1534,20 @@ class LipachatMessage(models.Model):
         return self._handle_response(response)
 
     def _send_template_message(self, config, headers, recipient):
+        compiled = self.env.context.get('lipachat_compiled_payload')
+        if compiled:
+            # Bulk sends: only the per-recipient values are serialised here
+            payload = self._render_compiled_payload(compiled, recipient)
+            _logger.debug("Sending compiled template payload: %s", payload)
+            response = config._gateway_request(
+                'post',
+                f"{config.api_base_url}/whatsapp/template",
+                headers=headers,
+                data=payload.encode('utf-8'),
+                timeout=30
+            )
+            return self._handle_response(response)
+
         components = self._prepare_template_components()
         
         # Ensure components are properly formatted
@@ -993,9 +1570,10 @@ class LipachatMessage(models.Model):
             }
         }
         
-        _logger.info("Sending template with data: %s", json.dumps(data, indent=2))
+        _logger.debug("Sending template with data: %s", data)
         
-        response = requests.post(
+        response = config._gateway_request(
+            'post',
             f"{config.api_base_url}/whatsapp/template",
             headers=headers,
             json=data,  # Let the requests library handle JSON serialization
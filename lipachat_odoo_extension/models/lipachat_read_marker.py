@@ -0,0 +1,77 @@
+from odoo import models, fields, api
+import logging
+
+from .lipachat_conversation import _CONVERSATION_MESSAGE_SQL
+
+_logger = logging.getLogger(__name__)
+
+class LipachatReadMarker(models.Model):
+    _name = 'lipachat.read.marker'
+    _description = 'WhatsApp Conversation Read Marker'
+    _log_access = False
+
+    user_id = fields.Many2one('res.users', 'User', required=True, ondelete='cascade', readonly=True)
+    partner_id = fields.Many2one('res.partner', 'Contact', required=True, ondelete='cascade', readonly=True)
+    last_read_message_id = fields.Integer('Last Read Message', readonly=True)
+    unread_count = fields.Integer('Unread', readonly=True,
+                                  help='Incoming messages received since the user last read the conversation')
+    version = fields.Integer('Version', readonly=True,
+                             help='Increases whenever the unread count changes, see lipachat.conversation')
+
+    _sql_constraints = [
+        ('user_partner_uniq', 'unique(user_id, partner_id)',
+         'There is a single read marker per user and contact.'),
+    ]
+
+    @api.model
+    def _mark_read(self, partner_id, last_message_id):
+        """Record that the current user has read a contact's conversation up to last_message_id"""
+        self.env['lipachat.message'].flush_model()
+        # Messages that arrived after what the user was shown stay unread
+        self.env.cr.execute(f"""
+            INSERT INTO lipachat_read_marker AS marker (user_id, partner_id, last_read_message_id, unread_count, version)
+            SELECT %(user_id)s, %(partner_id)s, %(last_message_id)s, COUNT(*),
+                   nextval('lipachat_conversation_version_seq')
+              FROM lipachat_message message
+             WHERE message.partner_id = %(partner_id)s
+               AND message.id > %(last_message_id)s
+               AND message.is_incoming
+               AND {_CONVERSATION_MESSAGE_SQL}
+            ON CONFLICT (user_id, partner_id) DO UPDATE SET
+                   last_read_message_id = GREATEST(marker.last_read_message_id, EXCLUDED.last_read_message_id),
+                   unread_count = EXCLUDED.unread_count,
+                   version = EXCLUDED.version
+             WHERE EXCLUDED.last_read_message_id >= marker.last_read_message_id
+        """, {'user_id': self.env.uid, 'partner_id': partner_id, 'last_message_id': last_message_id or 0})
+        self.invalidate_model()
+
+    @api.model
+    def _add_unread(self, partner_id, count):
+        """Account for incoming messages in the markers of the users who read the conversation before"""
+        if not count:
+            return
+        self.env.cr.execute("""
+            UPDATE lipachat_read_marker
+               SET unread_count = unread_count + %s,
+                   version = nextval('lipachat_conversation_version_seq')
+             WHERE partner_id = %s
+        """, (count, partner_id))
+        self.invalidate_model()
+
+    @api.model
+    def _recompute_unread(self, partner_ids=None):
+        """Recount unread messages from the history, for all or some contacts"""
+        partner_filter = "WHERE marker.partner_id IN %(partner_ids)s" if partner_ids else ""
+        self.env.cr.execute(f"""
+            UPDATE lipachat_read_marker marker
+               SET unread_count = (
+                       SELECT COUNT(*)
+                         FROM lipachat_message message
+                        WHERE message.partner_id = marker.partner_id
+                          AND message.id > marker.last_read_message_id
+                          AND message.is_incoming
+                          AND {_CONVERSATION_MESSAGE_SQL}),
+                   version = nextval('lipachat_conversation_version_seq')
+              {partner_filter}
+        """, {'partner_ids': tuple(partner_ids or ())})
+        self.invalidate_model()
@@ -250,6 +250,16 @@ class LipachatTemplate(models.Model):
             if not mime_type:
                 mime_type = 'application/octet-stream'
             
+            # Identical bytes were uploaded before: reuse the gateway media ID
+            media_registry = self.env['lipachat.media']
+            checksum = media_registry._compute_checksum(file_data)
+            media_id = media_registry._lookup(config, checksum)
+            if media_id:
+                self.header_media_id = media_id
+                self.upload_status = 'success'
+                self.upload_error_message = False
+                return True
+            
             # Prepare the multipart form data
             files = {
                 'file': (file_name, file_data, mime_type)
@@ -311,6 +321,8 @@ class LipachatTemplate(models.Model):
             # Check for successful response
             if response_data.get('status') == 'success' and response_data.get('data'):
                 self.header_media_id = response_data['data']
+                media_registry._register(config, checksum, self.header_media_id,
+                                         file_name=file_name, mime_type=mime_type, file_size=file_size)
                 self.upload_status = 'success'
                 self.upload_error_message = False
                 _logger.info("\n=== Upload Successful ===")
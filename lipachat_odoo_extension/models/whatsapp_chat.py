@@ -1,21 +1,48 @@
 # whatsapp_chat.py
 
 from odoo import models, fields, api
-from datetime import datetime, timedelta
-import pytz
+from odoo.tools import escape_psql
+from odoo.tools.lru import LRU
+from datetime import datetime
+import html
 import logging
 import json # Import json for RPC response
 from odoo.exceptions import ValidationError
 import re
-import requests
 import uuid
 
+from .lipachat_contact_session import _phone_key_sql
+from .lipachat_conversation import _CONVERSATION_MESSAGE_SQL
+
 _logger = logging.getLogger(__name__)
 
+# Message states shown as sent by the user, and their status icon
+_OUTGOING_STATES = ('SENT', 'READ', 'DELIVERED', 'FAILED', 'DRAFT', 'SCHEDULED')
+_STATUS_ICONS = {
+    'SENT': '✓',
+    'DELIVERED': '✓✓',
+    'READ': '✓✓',
+    'FAILED': '✗',
+    'DRAFT': '○',
+    'RECEIVED': '←',
+}
+
+# First pages of conversations per (database, partner, conversation version),
+# shared by the requests this worker serves
+_conversation_page_cache = LRU(512)
+
 class WhatsappChat(models.TransientModel):
     _name = 'whatsapp.chat'
     _description = 'WhatsApp Chat View Only'
 
+    # Conversations listed in the left panel per page
+    _contacts_limit = 200
+    # Messages loaded per page of conversation history
+    _history_page_size = 50
+    # Message search results per page, and characters of text shown per result
+    _search_page_size = 20
+    _search_snippet_size = 120
+
     contact = fields.Char(string="Selected Contact")
     contact_partner_id = fields.Integer(string="Selected Contact Partner ID")
     contacts_html = fields.Html(string="Conversations", compute="_compute_contacts_html")
@@ -201,7 +228,8 @@ class WhatsappChat(models.TransientModel):
                 "template": template_data
             }
 
-            response = requests.post(
+            response = config._gateway_request(
+                'post',
                 f"{config.api_base_url}/whatsapp/template",
                 headers=headers,
                 json=data,
@@ -211,6 +239,9 @@ class WhatsappChat(models.TransientModel):
             response_data = response.json() if response.content else {}
 
             if response_data.get('status') == 'success':
+                # A template opens a new session window for this contact
+                self.env['lipachat.contact.session']._invalidate(config, partner.mobile or partner.phone)
+                
                 # Create message record
                 self.env['lipachat.message'].create({
                     'partner_id': partner_id,
@@ -516,86 +547,49 @@ class WhatsappChat(models.TransientModel):
     @api.depends('contact_partner_id', 'last_refresh')
     def _compute_contacts_html(self):
         """
-        Computes the HTML for the list of conversations (contacts) on the left panel.
-        Groups messages by partner and shows the latest message and count.
+        Computes the HTML for the list of conversations (contacts) on the left panel,
+        for the initial server-side render. The chat client then renders the same
+        markup from rpc_get_contacts (see renderContactItem in whatsapp_chat_client.js).
         Highlights the currently selected contact.
         """
+        # The list is the same for every record: fetch it once
+        sorted_contacts = self._get_conversations(limit=self._contacts_limit)
         for record in self:
             _logger.debug(f"Computing contacts_html for record ID: {record.id}, selected_partner_id: {record.contact_partner_id}")
-            
-            # Only include messages with status 'sent'
-            messages = self.env['lipachat.message'].search([
-                  ('state', 'not in', ['FAILED', 'DRAFT']),
-                ('is_bulk_template', '=', False),
-                ('partner_id', '!=', False)
-            ])
-            
-            contacts_data = {}
-            for msg in messages:
-                partner = msg.partner_id
-                if partner and partner.active:
-                    if partner.id not in contacts_data:
-                        contacts_data[partner.id] = {
-                            'name': partner.name,
-                            'phone': msg.phone_number or partner.mobile or partner.phone,
-                            'latest_message': '',
-                            'latest_date': datetime.min,
-                            'message_count': 0
-                        }
-                    
-                    contacts_data[partner.id]['message_count'] += 1
-                    
-                    if msg.create_date and msg.create_date > contacts_data[partner.id]['latest_date']:
-                        contacts_data[partner.id]['latest_message'] = msg.message_text[:50] + '...' if len(msg.message_text or '') > 50 else (msg.message_text or '')
-                        contacts_data[partner.id]['latest_date'] = msg.create_date
-
-            sorted_contacts = sorted(contacts_data.items(), 
-                                key=lambda x: x[1]['latest_date'], 
-                                reverse=True)
-
-            html = '<div class="contacts-list">'
             if not sorted_contacts:
-                html += '<p class="text-muted" style="padding: 10px;">No conversations found. Send a message to start chatting or wait for incoming messages.</p>'
-            else:
-                for partner_id, contact_info in sorted_contacts:
-                    selected_style = ''
-                    selected_class = ''
-                    if record.contact_partner_id == partner_id:
-                        selected_style = 'background-color: #e8f5e8; border: 2px solid #25D366;'
-                        selected_class = 'selected'
-                    
-                    session = self.env['whatsapp.chat'].search([
-                    ('contact_partner_id', '=', partner_id),
-                    ('create_uid', '=', self.env.uid)], limit=1)
-                    is_expired = not (session and session.session_active)
-                    contact_color = 'red' if is_expired else '#25D366'
-                    
-                    html += f'''
-                    <div class="contact-item {selected_class}" data-partner-id="{partner_id}" data-contact-name="{contact_info['name']}" 
-                        style="padding: 10px; border-bottom: 1px solid #eee; cursor: pointer; border-radius: 5px; margin-bottom: 5px; {selected_style}"
-                        onmouseover="if(!this.classList.contains('selected')) this.style.backgroundColor='#f8f9fa'" 
-                        onmouseout="if(!this.classList.contains('selected')) this.style.backgroundColor='white'">
-                        <div style="display: flex; justify-content: space-between; align-items: center;">
-                            <div>
-                                <strong style="color: #25D366;">{contact_info['name']}</strong>
-                                <br>
-                                <small style="color: #666;">{contact_info['phone'] or 'No phone'}</small>
-                                <br>
-                                <small style="color: #888; font-style: italic;">{contact_info['latest_message']}</small>
-                            </div>
-                            <div style="text-align: right;">
-                                <small style="color: #999;">{contact_info['latest_date'].strftime('%m/%d %H:%M') if contact_info['latest_date'] and contact_info['latest_date'] != datetime.min else ''}</small>
-                                <br>
-                                <span style="background: #25D366; color: white; border-radius: 10px; padding: 2px 6px; font-size: 11px;">
-                                    {contact_info['message_count']} msg{'s' if contact_info['message_count'] != 1 else ''}
-                                </span>
-                            </div>
-                        </div>
-                    </div>
-                    '''
-            html += '</div>'
-            
-            record.contacts_html = html
+                record.contacts_html = (
+                    '<div class="contacts-list"><p class="text-muted" style="padding: 10px;">'
+                    'No conversations found. Send a message to start chatting or wait for incoming messages.'
+                    '</p></div>'
+                )
+                continue
+            record.contacts_html = '<div class="contacts-list">' + ''.join(
+                record._render_contact_html(partner_id, contact_info)
+                for partner_id, contact_info in sorted_contacts
+            ) + '</div>'
+
+    def _render_contact_html(self, partner_id, contact_info):
+        """Helper method to render one row of the conversation list, escaped, dated in the user's timezone"""
+        name = html.escape(contact_info['name'] or '')
+        count = contact_info['message_count']
+        unread = contact_info['unread_count']
+        date_display = ''
+        if contact_info['latest_date'] and contact_info['latest_date'] != datetime.min:
+            date_display = fields.Datetime.context_timestamp(self, contact_info['latest_date']).strftime('%m/%d %H:%M')
+        classes = ' unread' if unread else ''
+        classes += ' selected' if self.contact_partner_id == partner_id else ''
+        unread_badge = f'<span class="contact-unread" title="Unread messages">{unread}</span>' if unread else ''
+        return (
+            f'<div class="contact-item{classes}" data-partner-id="{partner_id}" data-contact-name="{name}">'
+            f'<div class="contact-row"><div>'
+            f'<strong class="contact-name">{name}</strong><br>'
+            f'<small class="contact-phone">{html.escape(contact_info["phone"] or "No phone")}</small><br>'
+            f'<small class="contact-preview">{html.escape(contact_info["latest_message"] or "")}</small>'
+            f'</div><div class="contact-meta">'
+            f'<small class="contact-date">{date_display}</small><br>'
+            f'<span class="contact-count">{count} msg{"s" if count != 1 else ""}</span>{unread_badge}'
+            f'</div></div></div>'
+        )
 
 
 
@@ -617,8 +611,9 @@ class WhatsappChat(models.TransientModel):
                 '''
                 continue
 
-            # Fetch messages only for the current selected contact
-            messages_data = self._get_messages_for_partner(record.contact_partner_id)
+            # Fetch the latest page only, older messages are loaded on scroll
+            messages_data = [self._message_payload(message) for message in self._get_messages_for_partner(
+                record.contact_partner_id, limit=self._history_page_size)]
             
             if not messages_data:
                 record.messages_html = f'''
@@ -631,113 +626,127 @@ class WhatsappChat(models.TransientModel):
                 '''
                 continue
 
-            html = '<div class="chat-messages" style="max-height: 400px; overflow-y: auto; padding: 10px;" id="chat-messages-container">'
+            messages_html = '<div class="chat-messages" style="max-height: 400px; overflow-y: auto; padding: 10px;" id="chat-messages-container">'
             
             for msg_data in messages_data:
                 # Use the helper to render message HTML
-                html += self._render_message_html(msg_data, record.contact)
+                messages_html += self._render_message_html(msg_data, record.contact)
             
-            html += '</div>'
+            messages_html += '</div>'
             # Remove the embedded <script> for auto-scroll here too.
-            record.messages_html = html
+            record.messages_html = messages_html
 
 
     def _render_message_html(self, msg_data, contact_name):
         """
-        Helper method to render a single message HTML bubble.
-        This allows both compute methods and RPC methods to use it.
+        Helper method to render a single message HTML bubble, for the initial
+        server-side render. The chat client renders the same markup from
+        _message_payload (see renderMessageBubble in whatsapp_chat_client.js).
         """
-        status_color = {
-            'SENT': '#25D366',
-            'READ': '#34B7F1', 
-            'FAILED': '#dc3545',
-            'DRAFT': '#6c757d',
-            'RECEIVED': '#A9A9A9' 
-        }.get(msg_data['state'], '#6c757d')
-        
-        status_icon = {
-            'SENT': '✓',
-            'DELIVERED': '✓✓',
-            'READ': '✓✓',
-            'FAILED': '✗',
-            'DRAFT': '○',
-            'RECEIVED': '←' 
-        }.get(msg_data['state'], '○')
-        is_sent_by_me = (msg_data['state'] in ['SENT', 'READ', 'DELIVERED', 'FAILED', 'DRAFT']) 
-        bubble_align = 'margin-left: auto;' if is_sent_by_me else 'margin-right: auto;'
-        bubble_background = '#d9fdd3' if is_sent_by_me else '#fff'
+        state = msg_data['state']
+        is_sent_by_me = state in _OUTGOING_STATES
 
         content = "Unsupported Message Type"
-        if msg_data['message_type'] == 'text':
-            # Convert line breaks to HTML <br> tags and escape HTML
-            message_text = msg_data['message_text'] or 'Empty message'
-            # First escape HTML entities to prevent XSS
-            import html
-            escaped_text = html.escape(message_text)
-            # Then convert line breaks to <br> tags
-            content = escaped_text.replace('\n', '<br>')
-        elif msg_data['message_type'] == 'media':
-            content = f"📎 {msg_data['media_type'].title()} Media"
-            if msg_data['caption']:
+        if msg_data['type'] == 'text':
+            # Escape HTML entities to prevent XSS, then keep the line breaks
+            content = html.escape(msg_data['text'] or 'Empty message').replace('\n', '<br>')
+        elif msg_data['type'] == 'media':
+            content = f"📎 {(msg_data['media_type'] or '').title()} Media"
+            if msg_data['text']:
                 # Also handle line breaks in captions
-                import html
-                escaped_caption = html.escape(msg_data['caption'])
-                formatted_caption = escaped_caption.replace('\n', '<br>')
-                content += f": {formatted_caption}"
-        elif msg_data['message_type'] == 'template':
-            content = f"📋 Template: {msg_data['template_name'].name}"
-
-        # Format date for display
-        msg_date_obj = datetime.fromisoformat(msg_data['create_date']) if msg_data['create_date'] else None
-        if msg_date_obj: 
-            eat_date = msg_date_obj + timedelta(hours=3)
-            msg_date_display = eat_date.strftime('%m/%d/%Y %H:%M') 
-        # msg_date_display = msg_date_obj.strftime('%m/%d/%Y %H:%M') if msg_date_obj else ''
-        
-        return f'''
-        <div class="message-bubble" 
-            style="background: {bubble_background}; font-size: 13px; max-width: 55%; min-width: 300px; padding: 4px 12px; line-height: 1.4; position: relative; margin: 8px 0; border-radius: 7.5px; position: relative; {bubble_align}">
-            <div style="">
-                <strong style="color: {status_color};">{'You' if is_sent_by_me else contact_name}</strong>
-                <small style="color: #666; float: right; font-size: 12px;">{msg_date_display}</small>
-            </div>
-            <div style="word-wrap: break-word; white-space: normal;">
-                {content}
-            </div>
-            <div style="text-align: right; font-size: 12px; color: {status_color};">
-                <span title="{msg_data['state'].title()}">{status_icon} {msg_data['state'].title()}</span>
-                {f'<br><span style="color: #dc3545; font-size: 11px;">Error: {html.escape(msg_data["error_message"])}</span>' if msg_data["state"] == 'failed' and msg_data["error_message"] else ''}
-            </div>
-        </div>
-        '''
-
-
-    def _get_messages_for_partner(self, partner_id, last_message_id=None):
+                caption = html.escape(msg_data['text']).replace('\n', '<br>')
+                content += f": {caption}"
+        elif msg_data['type'] == 'template':
+            content = f"📋 Template: {html.escape(msg_data['text'])}"
+
+        msg_date_display = ''
+        if msg_data['date']:
+            msg_date = fields.Datetime.context_timestamp(self, fields.Datetime.to_datetime(msg_data['date']))
+            msg_date_display = msg_date.strftime('%m/%d/%Y %H:%M')
+
+        error = ''
+        if state == 'FAILED' and msg_data.get('error'):
+            error = f'<br><span class="message-error">Error: {html.escape(msg_data["error"])}</span>'
+
+        author = 'You' if is_sent_by_me else html.escape(contact_name or '')
+        return (
+            f'<div class="message-bubble {"outgoing" if is_sent_by_me else "incoming"} message-state-{state.lower()}" '
+            f'data-message-id="{msg_data["id"]}">'
+            f'<div><strong class="message-author">{author}</strong>'
+            f'<small class="message-date">{msg_date_display}</small></div>'
+            f'<div class="message-content">{content}</div>'
+            f'<div class="message-status"><span title="{state.title()}">'
+            f'{_STATUS_ICONS.get(state, "○")} {state.title()}</span>{error}</div>'
+            f'</div>'
+        )
+
+    def _get_messages_for_partner(self, partner_id, since_version=None, before_id=None, since_id=None, limit=None):
         """
-        Helper method to fetch and format messages for a partner.
+        Helper method to fetch the displayed messages of a partner, oldest first.
         Can be called internally by computes or by RPC.
+        With since_version only the messages created or changed after that
+        conversation version are returned. With a limit only the latest messages,
+        older than before_id if given, are returned.
+        since_id drops the messages displayed before that one.
+
+        Returns rows (dicts) holding only the columns _message_payload needs,
+        read with one query instead of through message records.
         """
-        domain = [
-            ('partner_id', '=', partner_id),
-            ('is_bulk_template', '=', False),
-            ('state', 'not in', ['FAILED', 'DRAFT']),  # Only include sent messages
-        ]
-        if last_message_id:
-            domain.append(('id', '>', last_message_id))
-        
-        messages = self.env['lipachat.message'].search(domain, order='create_date asc')
-        
-        return [{
-            'id': msg.id,
-            'message_text': msg.message_text,
-            'create_date': msg.create_date.isoformat() if msg.create_date else None,
-            'state': msg.state,
-            'message_type': msg.message_type,
-            'media_type': msg.media_type,
-            'caption': msg.caption,
-            'template_name': msg.template_name,
-            'error_message': msg.error_message
-        } for msg in messages]
+        Message = self.env['lipachat.message']
+        Message.check_access_rights('read')
+        Message.flush_model(['partner_id', 'is_bulk_template', 'state', 'message_type', 'message_text',
+                             'caption', 'media_type', 'template_name', 'error_message'])
+        self.env['lipachat.template'].flush_model(['name'])
+        conditions = []
+        params = {'partner_id': partner_id, 'since_version': since_version, 'before_id': before_id,
+                  'since_id': since_id, 'limit': limit}
+        if since_version:
+            # Messages are stamped with the conversation version of the transaction that changed them
+            conditions.append("message.chat_version > %(since_version)s")
+        if before_id:
+            # Keyset cursor on (create_date, id), the display order of the history
+            conditions.append("""(message.create_date, message.id) <
+                (SELECT create_date, id FROM lipachat_message WHERE id = %(before_id)s)""")
+        if since_id:
+            conditions.append("""(message.create_date, message.id) >=
+                (SELECT create_date, id FROM lipachat_message WHERE id = %(since_id)s)""")
+        filter_sql = ''.join(f"\n               AND {condition}" for condition in conditions)
+        order = "DESC" if limit else "ASC"
+
+        self.env.cr.execute(f"""
+            SELECT message.id, message.message_type, message.message_text, message.caption,
+                   message.media_type, template.name AS template_name, message.state,
+                   message.error_message, message.create_date
+              FROM lipachat_message message
+         LEFT JOIN lipachat_template template ON template.id = message.template_name
+             WHERE message.partner_id = %(partner_id)s
+               AND {_CONVERSATION_MESSAGE_SQL}{filter_sql}
+          ORDER BY message.create_date {order}, message.id {order}
+             {"LIMIT %(limit)s" if limit else ""}
+        """, params)
+        rows = self.env.cr.dictfetchall()
+        return rows[::-1] if limit else rows
+
+    @api.model
+    def _message_payload(self, message):
+        """Compact description of a message row (see _get_messages_for_partner), rendered by the chat client"""
+        text = message['message_text']
+        if message['message_type'] == 'media':
+            text = message['caption']
+        elif message['message_type'] == 'template':
+            text = message['template_name']
+        payload = {
+            'id': message['id'],
+            'type': message['message_type'],
+            'text': text or '',
+            'state': message['state'],
+            'date': fields.Datetime.to_string(message['create_date']),
+        }
+        if message['message_type'] == 'media':
+            payload['media_type'] = message['media_type']
+        if message['state'] == 'FAILED' and message['error_message']:
+            payload['error'] = message['error_message']
+        return payload
     
 
 
@@ -846,129 +855,332 @@ class WhatsappChat(models.TransientModel):
     
 
 
+    def _get_contact_name(self, partner_id):
+        partner = self.env['res.partner'].browse(partner_id)
+        return partner.name if partner.exists() else "Unknown Contact"
+
     @api.model
-    def rpc_get_messages_html(self, partner_id):
+    def rpc_get_messages_delta(self, partner_id, last_message_id=0, oldest_message_id=None, version=None):
         """
-        New RPC method to fetch messages and render their HTML for a given partner.
-        This will be called by JavaScript to update the chat area without a full reload.
+        Return only the messages created or changed since the client's last poll.
+
+        Without last_message_id or version the latest page of the conversation
+        is returned ('reset'); otherwise 'messages' holds the messages created
+        or changed since the conversation version the client holds, no older
+        than oldest_message_id (the loaded window), for the client to append
+        or patch in place. Messages are described by _message_payload.
+
+        When the conversation version the client holds is still current, only
+        {'not_modified': True} is returned.
         """
-        _logger.info(f"RPC: rpc_get_messages_html called for partner_id: {partner_id}")
         if not partner_id:
-            return "" # Return empty string if no partner
-
-        messages_data = self._get_messages_for_partner(partner_id)
-        
-        # Get the contact name for rendering the messages
-        partner = self.env['res.partner'].browse(partner_id)
-        contact_name = partner.name if partner.exists() else "Unknown Contact"
-
-        html_content = ""
-        if not messages_data:
-            html_content = f'''
-            <div style="flex: 1; display: flex; align-items: center; justify-content: center; flex-direction: column; color: #666; height: 300px;">
-                <div style="font-size: 36px; margin-bottom: 15px;">📭</div>
-                <h4>No messages found</h4>
-                <p>No conversation history with {contact_name}</p>
-                <small>Start by sending a message below</small>
-            </div>
-            '''
+            return {'reset': True, 'messages': [], 'last_message_id': 0}
+
+        # Read before the messages: changes committed in between are sent again, never missed
+        current_version = self.env['lipachat.conversation']._get_version(partner_id)
+        reset = not last_message_id or not version
+        if not reset and version == current_version:
+            return {'not_modified': True, 'version': current_version}
+
+        cache_key = (self.env.cr.dbname, partner_id, current_version)
+        if reset:
+            cached = _conversation_page_cache.get(cache_key)
+            if cached:
+                return dict(cached, version=current_version)
+            # First paint: only the latest page, older ones are loaded on scroll
+            messages = self._get_messages_for_partner(partner_id, limit=self._history_page_size + 1)
+            has_more = len(messages) > self._history_page_size
+            messages = messages[-self._history_page_size:]
         else:
-            for msg_data in messages_data:
-                html_content += self._render_message_html(msg_data, contact_name)
-        
-        return html_content
+            messages = self._get_messages_for_partner(partner_id, since_version=version, since_id=oldest_message_id)
+        result = {
+            'reset': reset,
+            'messages': [self._message_payload(message) for message in messages],
+            'last_message_id': max([message['id'] for message in messages] + [last_message_id or 0]),
+        }
+        if reset:
+            result.update({
+                'has_more': has_more,
+                'oldest_message_id': messages[0]['id'] if messages else False,
+            })
+            # Version 0: no conversation row versions these messages yet, keep them out of the cache
+            if current_version:
+                _conversation_page_cache[cache_key] = result
+        return dict(result, version=current_version)
 
     @api.model
-    def rpc_get_contacts_html(self):
+    def rpc_get_messages_page(self, partner_id, before_id, limit=None):
         """
-        New RPC method to fetch and render the contacts list HTML.
-        This can be used to refresh the left panel without a full form reload.
+        Return the page of history just older than before_id, for infinite scroll.
         """
-        # Only include messages with status 'sent'
-        messages = self.env['lipachat.message'].search([
-            ('state', 'not in', ['FAILED', 'DRAFT']),
-            ('is_bulk_template', '=', False),
-            ('partner_id', '!=', False)
-        ])
-        
-        contacts_data = {}
-        for msg in messages:
-            partner = msg.partner_id
-            if partner and partner.active:
-                if partner.id not in contacts_data:
-                    contacts_data[partner.id] = {
-                        'name': partner.name,
-                        'phone': msg.phone_number or partner.mobile or partner.phone,
-                        'latest_message': '',
-                        'latest_date': datetime.min,
-                        'message_count': 0
-                    }
-                
-                contacts_data[partner.id]['message_count'] += 1
-                
-                if msg.create_date and msg.create_date > contacts_data[partner.id]['latest_date']:
-                    contacts_data[partner.id]['latest_message'] = msg.message_text[:50] + '...' if len(msg.message_text or '') > 50 else (msg.message_text or '')
-                    contacts_data[partner.id]['latest_date'] = msg.create_date
+        limit = limit or self._history_page_size
+        messages = self._get_messages_for_partner(partner_id, before_id=before_id, limit=limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[-limit:]
+        return {
+            'messages': [self._message_payload(message) for message in messages],
+            'has_more': has_more,
+            'oldest_message_id': messages[0]['id'] if messages else before_id,
+        }
 
-        sorted_contacts = sorted(contacts_data.items(), 
-                            key=lambda x: x[1]['latest_date'], 
-                            reverse=True)
+    @api.model
+    def rpc_get_messages_around(self, partner_id, message_id):
+        """
+        Return the conversation from a little before message_id up to its latest
+        message, shaped like a reset delta, for jumping to a search result.
+        """
+        half_page = self._history_page_size // 2
+        version = self.env['lipachat.conversation']._get_version(partner_id)
+        context = self._get_messages_for_partner(partner_id, before_id=message_id, limit=half_page + 1)
+        has_more = len(context) > half_page
+        context = context[-half_page:]
+        # The window must reach the latest message for the delta polls to append to it
+        messages = self._get_messages_for_partner(partner_id, since_id=context[0]['id'] if context else message_id)
+        return {
+            'reset': True,
+            'messages': [self._message_payload(message) for message in messages],
+            'last_message_id': max((message['id'] for message in messages), default=0),
+            'has_more': has_more,
+            'oldest_message_id': messages[0]['id'] if messages else False,
+            'version': version,
+        }
 
-        html = '<div class="contacts-list">'
-        if not sorted_contacts:
-            html += '<p class="text-muted" style="padding: 10px;">No conversations found. Send a message to start chatting or wait for incoming messages.</p>'
-        else:
-            for partner_id, contact_info in sorted_contacts:
-                if contact_info['latest_date'] and contact_info['latest_date'] != datetime.min:
-                    eat_date = contact_info['latest_date'] + timedelta(hours=3)
-                    date_display = eat_date.strftime('%m/%d %H:%M')
-                else:
-                    date_display = ''
-        
-                html += f'''
-                <div class="contact-item" data-partner-id="{partner_id}" data-contact-name="{contact_info['name']}" 
-                    style="padding: 10px; border-bottom: 1px solid #eee; cursor: pointer; border-radius: 5px; margin-bottom: 5px;"
-                    onmouseover="if(!this.classList.contains('selected')) this.style.backgroundColor='#f8f9fa'" 
-                    onmouseout="if(!this.classList.contains('selected')) this.style.backgroundColor='white'">
-                    <div style="display: flex; justify-content: space-between; align-items: center;">
-                        <div>
-                            <strong style="color: #25D366;">{contact_info['name']}</strong>
-                            <br>
-                            <small style="color: #666;">{contact_info['phone'] or 'No phone'}</small>
-                            <br>
-                            <small style="color: #888; font-style: italic;">{contact_info['latest_message']}</small>
-                        </div>
-                        <div style="text-align: right;">
-                            <small style="color: #999;">{date_display}</small>
-                            <br>
-                            <span style="background: #25D366; color: white; border-radius: 10px; padding: 2px 6px; font-size: 11px;">
-                                {contact_info['message_count']} msg{'s' if contact_info['message_count'] != 1 else ''}
-                            </span>
-                        </div>
-                    </div>
-                </div>
-                '''
-        html += '</div>'
-        return html
-    
+    @api.model
+    def rpc_search_messages(self, query, limit=None, offset=0):
+        """
+        Search the text and caption of the displayed messages of all conversations.
+
+        Matches are ILIKE '%query%', served by the trigram indexes of
+        lipachat.message, and ranked by trigram word similarity (most recent
+        first without pg_trgm).
+        """
+        query = (query or '').strip()
+        limit = limit or self._search_page_size
+        if not query:
+            return {'results': [], 'has_more': False}
+
+        Message = self.env['lipachat.message']
+        Message.check_access_rights('read')
+        Message.flush_model(['message_text', 'caption', 'state', 'is_bulk_template', 'partner_id'])
+        rank = """GREATEST(word_similarity(%(query)s, COALESCE(message.message_text, '')),
+                           word_similarity(%(query)s, COALESCE(message.caption, ''))) DESC,""" \
+            if Message._has_trigram() else ""
+        self.env.cr.execute(f"""
+            SELECT message.id, message.partner_id, partner.name,
+                   COALESCE(NULLIF(message.message_text, ''), message.caption), message.create_date
+              FROM lipachat_message message
+              JOIN res_partner partner ON partner.id = message.partner_id
+             WHERE (message.message_text ILIKE %(pattern)s OR message.caption ILIKE %(pattern)s)
+               AND {_CONVERSATION_MESSAGE_SQL}
+          ORDER BY {rank} message.create_date DESC, message.id DESC
+             LIMIT %(limit)s OFFSET %(offset)s
+        """, {'query': query, 'pattern': f'%{escape_psql(query)}%', 'limit': limit + 1, 'offset': offset or 0})
+        rows = self.env.cr.fetchall()
+
+        return {
+            'results': [{
+                'message_id': message_id,
+                'partner_id': partner_id,
+                'name': name,
+                'snippet': self._search_snippet(text or '', query),
+                'date': fields.Datetime.to_string(create_date),
+            } for message_id, partner_id, name, text, create_date in rows[:limit]],
+            'has_more': len(rows) > limit,
+        }
+
+    def _search_snippet(self, text, query):
+        """Return the part of text around the first occurrence of query"""
+        size = self._search_snippet_size
+        start = max(0, text.lower().find(query.lower()) - size // 3)
+        snippet = text[start:start + size]
+        return ('…' if start else '') + snippet + ('…' if start + size < len(text) else '')
+
+    @api.model
+    def rpc_poll(self, partner_id=None, contacts_version=None, last_message_id=0, oldest_message_id=None, conversation_version=None, mark_read=False,
+                 contacts_limit=None, contacts_filters=None):
+        """
+        Everything a refresh of the chat interface needs, in one round trip.
+
+        'messages' is the rpc_get_messages_delta answer for the open
+        conversation, 'partner' its contact's id and name, 'session' the
+        session state of that contact and 'contacts' the rpc_get_contacts
+        answer (its first contacts_limit contacts matching contacts_filters);
+        unchanged parts come back as "not modified". With mark_read, the incoming messages returned are
+        marked read before the contacts are listed, so that the unread counts
+        are already current.
+        """
+        result = {}
+        if partner_id:
+            delta = self.rpc_get_messages_delta(partner_id, last_message_id, oldest_message_id,
+                                                conversation_version)
+            if mark_read and not delta.get('not_modified') and (
+                    delta['reset'] or any(msg['state'] not in _OUTGOING_STATES for msg in delta['messages'])):
+                self.rpc_mark_conversation_read(partner_id, delta['last_message_id'])
+            partner = self.env['res.partner'].browse(partner_id)
+            result.update({
+                'partner': {'id': partner.id, 'name': partner.name},
+                'messages': delta,
+                'session': self.check_contact_active_session(partner.mobile or partner.phone),
+            })
+        result['contacts'] = self.rpc_get_contacts(limit=contacts_limit, version=contacts_version,
+                                                   filters=contacts_filters)
+        return result
+
+    @api.model
+    def rpc_mark_conversation_read(self, partner_id, last_message_id):
+        """Mark a contact's conversation read by the current user up to the last message shown"""
+        if partner_id:
+            self.env['lipachat.read.marker']._mark_read(partner_id, last_message_id)
+        return True
+
+    @api.model
+    def rpc_get_contacts(self, limit=None, offset=0, version=None, filters=None):
+        """
+        Return a page of the conversation list of the left panel, rendered by the
+        chat client, or only {'not_modified': True} when the client's list
+        version is current.
+
+        filters may hold 'search' (name or phone prefix), 'unread' and
+        'active_session' (contacts whose last checked session is active).
+        """
+        filters = filters or {}
+        current_version = self.env['lipachat.conversation']._get_version()
+        # Sessions expire without changing the version: a list filtered on them is always sent
+        if version == current_version and not filters.get('active_session'):
+            return {'not_modified': True, 'version': current_version}
+        limit = limit or self._contacts_limit
+        conversations = self._get_conversations(
+            limit=limit + 1, offset=offset, search=filters.get('search'),
+            unread_only=filters.get('unread'), active_session_only=filters.get('active_session'))
+        contacts = [{
+            'partner_id': partner_id,
+            'name': contact_info['name'],
+            'phone': contact_info['phone'] or '',
+            'preview': contact_info['latest_message'],
+            'date': fields.Datetime.to_string(contact_info['latest_date'])
+                    if contact_info['latest_date'] != datetime.min else False,
+            'message_count': contact_info['message_count'],
+            'unread_count': contact_info['unread_count'],
+        } for partner_id, contact_info in conversations[:limit]]
+        return {'contacts': contacts, 'has_more': len(conversations) > limit, 'version': current_version}
+
+    @api.model
+    def _phone_search_prefix(self, search):
+        """Return the normalised number a typed (partial) number starts with, as _normalize_phone reads it"""
+        digits = re.sub(r'[^\d]', '', search)
+        if not digits:
+            return False
+        if search.startswith('+'):
+            return digits
+        if digits.startswith('00'):
+            return digits[2:] or False
+        if digits.startswith('0'):
+            # National number: the trunk 0 stands for the calling code
+            country_code = self.env['lipachat.message']._get_phone_country_code(self._get_chat_config())
+            return country_code + digits[1:] if country_code else False
+        return digits
+
+    @api.model
+    def _get_conversations(self, limit=None, offset=0, search=None, unread_only=False, active_session_only=False):
+        """
+        Return [(partner_id, contact_info)] for the conversation list, most recent first.
+
+        Reads the maintained lipachat.conversation rows in last-message order
+        (an index scan that stops after the requested page); contacts with
+        conversations on several configurations are listed once. Unread counts
+        are the current user's (lipachat.read.marker), or the messages received
+        since the last reply for conversations the user never opened.
+
+        search keeps the contacts with a name word or a phone number starting
+        with it (national numbers are read with the chat's calling code), unread_only those with unread messages and active_session_only
+        those whose cached session (lipachat.contact.session) is active.
+        """
+        self.env['res.partner'].flush_model(['name', 'active', 'mobile', 'phone'])
+        conditions = []
+        params = {'user_id': self.env.uid, 'limit': limit, 'offset': offset or 0}
+        search = (search or '').strip()
+        if search:
+            phone_prefix = self._phone_search_prefix(search)
+            # Served by the phone_key index of lipachat.conversation
+            phone_condition = "OR conversation.phone_key LIKE %(phone_prefix)s" if phone_prefix else ""
+            conditions.append(f"""(
+                partner.name ILIKE %(name_prefix)s OR partner.name ILIKE %(word_prefix)s {phone_condition}
+            )""")
+            params.update({
+                'name_prefix': f'{escape_psql(search)}%',
+                'word_prefix': f'% {escape_psql(search)}%',
+                'phone_prefix': f'{phone_prefix}%',
+            })
+        if unread_only:
+            conditions.append("COALESCE(marker.unread_count, totals.unread_count) > 0")
+        if active_session_only:
+            # Sessions are cached under the chat's configuration, keyed on the
+            # normalised number the chat checks (see check_contact_active_session)
+            config = self._get_chat_config()
+            conditions.append(f"""EXISTS (
+                SELECT 1
+                  FROM lipachat_contact_session session
+                 WHERE session.config_id = %(session_config_id)s
+                   AND session.phone IN ({_phone_key_sql("COALESCE(NULLIF(partner.mobile, ''), partner.phone)")},
+                                         {_phone_key_sql("conversation.phone_number")})
+                   AND session.session_active
+                   AND session.valid_until > (now() AT TIME ZONE 'UTC')
+            )""")
+            params.update({
+                'session_config_id': config.id or 0,
+                'country_code': self.env['lipachat.message']._get_phone_country_code(config) or None,
+            })
+        filter_sql = ''.join(f"\n               AND {condition}" for condition in conditions)
+
+        self.env.cr.execute(f"""
+            SELECT conversation.partner_id,
+                   partner.name,
+                   COALESCE(conversation.phone_number, partner.mobile, partner.phone),
+                   conversation.last_message_preview,
+                   conversation.last_message_date,
+                   totals.message_count,
+                   COALESCE(marker.unread_count, totals.unread_count)
+              FROM lipachat_conversation conversation
+              JOIN res_partner partner ON partner.id = conversation.partner_id AND partner.active
+         LEFT JOIN lipachat_read_marker marker
+                ON marker.partner_id = conversation.partner_id AND marker.user_id = %(user_id)s
+              CROSS JOIN LATERAL (
+                    SELECT SUM(other.message_count) AS message_count,
+                           SUM(other.unread_count) AS unread_count
+                      FROM lipachat_conversation other
+                     WHERE other.partner_id = conversation.partner_id
+              ) totals
+             WHERE NOT EXISTS (
+                    SELECT 1
+                      FROM lipachat_conversation newer
+                     WHERE newer.partner_id = conversation.partner_id
+                       AND (newer.last_message_date, newer.id) > (conversation.last_message_date, conversation.id)
+             ){filter_sql}
+          ORDER BY conversation.last_message_date DESC, conversation.id DESC
+             LIMIT %(limit)s OFFSET %(offset)s
+        """, params)
+
+        return [(partner_id, {
+            'name': name,
+            'phone': phone,
+            'latest_message': preview or '',
+            'latest_date': latest_date or datetime.min,
+            'message_count': message_count,
+            'unread_count': unread_count,
+        }) for partner_id, name, phone, preview, latest_date, message_count, unread_count in self.env.cr.fetchall()]
 
     @api.model
     def get_most_recent_contact(self):
         """
-        New RPC method to immediately get the most recent contact for faster initialization
+        New RPC method to immediately get the most recent contact for faster initialization:
+        the first row of the conversation list, read from lipachat.conversation.
         """
-        most_recent_message = self.env['lipachat.message'].search([
-            ('state', 'not in', ['FAILED', 'DRAFT']),
-            ('is_bulk_template', '=', False),
-            ('partner_id', '!=', False)
-        ], order='create_date desc', limit=1)
-        
-        if most_recent_message and most_recent_message.partner_id:
+        for partner_id, contact_info in self._get_conversations(limit=1):
             return {
-                'partner_id': most_recent_message.partner_id.id,
-                'name': most_recent_message.partner_id.name
+                'partner_id': partner_id,
+                'name': contact_info['name']
             }
-        
+
         return {}
     
     
@@ -979,8 +1191,8 @@ class WhatsappChat(models.TransientModel):
         most_recent = self.get_most_recent_contact()
         if not most_recent:
             return {
-                'contacts_html': self.rpc_get_contacts_html(),
-                'messages_html': '',
+                'contacts': self.rpc_get_contacts()['contacts'],
+                'messages': [],
                 'partner_id': False,
                 'session_info': {'active': False}
             }
@@ -988,61 +1200,28 @@ class WhatsappChat(models.TransientModel):
         return {
             'partner_id': most_recent['partner_id'],
             'partner_name': most_recent['name'],
-            'contacts_html': self.rpc_get_contacts_html(),
-            'messages_html': self.rpc_get_messages_html(most_recent['partner_id']),
+            'contacts': self.rpc_get_contacts()['contacts'],
+            'messages': self.rpc_get_messages_delta(most_recent['partner_id'])['messages'],
             'session_info': self.rpc_get_session_info(most_recent['partner_id'])
         }
     
 
+    def _get_chat_config(self):
+        """Configuration the chat interface checks (and caches) contact sessions with"""
+        return self.env['lipachat.config'].search([('active', '=', True)], limit=1)
+
     def check_contact_active_session(self, contact_phone):
         """Check if contact has an active session via the API endpoint"""
         try:
             if not contact_phone:
                 return {'status': False, 'message': 'Missing phone number'}
             
-            config = self.env['lipachat.config'].search([('active', '=', True)], limit=1)
+            config = self._get_chat_config()
             if not config:
                 return {'status': False, 'message': 'No active configuration'}
             
-            url = f"https://app.lipachat.com/api/v1/sandbox/contact/active-session/{contact_phone}"
-            headers = {
-                'apiKey': config.api_key,
-             }
-            response = requests.get(url, headers=headers, timeout=5)
-
-            _logger.info("Session info response:\n%s", response.json())
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('status') and data.get('session'):
-                    # Check if session is expired
-                    expires_at = data['session'].get('expiresAt')
-                    if expires_at:
-                        try:
-                            expires_dt = datetime.strptime(expires_at, "%Y-%m-%dT%H:%M:%S.%f%z")
-                            now = datetime.now(pytz.UTC)
-                            if expires_dt > now:
-                                return {
-                                    'status': True,
-                                    'session_active': True,
-                                    'expires_at': expires_at,
-                                    'session_data': data['session']
-                                }
-                        except ValueError as e:
-                            _logger.error(f"Error parsing datetime {expires_at}: {str(e)}")
-                            # Continue with expired session if parsing fails
-                
-                return {
-                    'status': data.get('status', False),
-                    'message': data.get('message', 'No active session'),
-                    'session_active': False
-                }
-                
-            return {
-                'status': False,
-                'message': f'API request failed with status {response.status_code}',
-                'session_active': False
-            }
+            # Sessions last until expiresAt: the API is only asked when the cached answer is stale
+            return self.env['lipachat.contact.session']._check_sessions(config, [contact_phone])[contact_phone]
             
         except Exception as e:
             _logger.error(f"Error checking active session: {str(e)}")
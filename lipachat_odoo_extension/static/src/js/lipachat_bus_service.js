@@ -0,0 +1,28 @@
+/** @odoo-module **/
+// static/src/js/lipachat_bus_service.js
+// Relays the chat notifications of the Odoo bus to the vanilla chat client
+
+import { registry } from "@web/core/registry";
+
+const CHAT_BUS_CHANNEL = "lipachat_chat";
+
+function setBusStatus(connected) {
+    window.lipachatBusConnected = connected;
+    window.dispatchEvent(new CustomEvent("lipachat:bus-status", { detail: { connected } }));
+}
+
+export const lipachatBusService = {
+    dependencies: ["bus_service"],
+
+    start(env, { bus_service }) {
+        bus_service.subscribe("lipachat.chat/updated", (payload) => {
+            window.dispatchEvent(new CustomEvent("lipachat:chat-updated", { detail: payload }));
+        });
+        bus_service.addEventListener("connect", () => setBusStatus(true));
+        bus_service.addEventListener("reconnect", () => setBusStatus(true));
+        bus_service.addEventListener("disconnect", () => setBusStatus(false));
+        bus_service.addChannel(CHAT_BUS_CHANNEL);
+    },
+};
+
+registry.category("services").add("lipachat_bus", lipachatBusService);
@@ -4,12 +4,47 @@
 (function() {
     'use strict';
 
+    // Message states shown as sent by the user, and their status icon
+    const OUTGOING_STATES = ['SENT', 'READ', 'DELIVERED', 'FAILED', 'DRAFT', 'SCHEDULED'];
+    const STATUS_ICONS = {
+        'SENT': '✓',
+        'DELIVERED': '✓✓',
+        'READ': '✓✓',
+        'FAILED': '✗',
+        'DRAFT': '○',
+        'RECEIVED': '←',
+    };
+
+    // Contact sidebar: fixed row height (see chat_interface.css), page size and rows rendered beyond the viewport
+    const CONTACT_ROW_HEIGHT = 84;
+    const CONTACTS_PAGE_SIZE = 50;
+    const CONTACTS_OVERSCAN = 5;
+
     class WhatsAppChatClient {
         constructor() {
             this.currentSelectedPartnerId = null;
             this.currentSelectedContactName = null;
             this.autoRefreshInterval = null;
             this.lastMessageId = 0;
+            this.oldestMessageId = null;
+            this.hasMoreHistory = false;
+            this.isLoadingHistory = false;
+            // Versions of the displayed conversation and contacts list, "not modified" answers skip rendering
+            this.conversationVersion = null;
+            this.contactsVersion = null;
+            // Loaded conversations of the sidebar, of which only the visible rows are rendered
+            this.contacts = [];
+            this.contactsHasMore = false;
+            this.isLoadingContacts = false;
+            this.contactFilters = { search: '', unread: false, active_session: false };
+            this.contactFilterTimeout = null;
+            this.contactsRenderFrame = null;
+            this.searchQuery = '';
+            this.searchOffset = 0;
+            this.searchTimeout = null;
+            this.busConnected = false;
+            this.pendingChatUpdates = new Set();
+            this.chatUpdateTimeout = null;
             this.isInitialized = false;
             this.isSending = false;
             this.eventListeners = [];
@@ -26,7 +61,6 @@
             this.lastUIState = null;
             this.lastContactsState = null;
             this.isUpdatingUI = false;
-            this.sessionCheckInProgress = false;
             this.forceContactReselection = false;
             this.debouncedUpdateInputFields = this.debounce(this.updateInputFields.bind(this), 100);
 
@@ -34,14 +68,14 @@
 
         }
 
-        addEventListener(element, event, handler) {
+        addEventListener(element, event, handler, options = false) {
             if (!element || !event || !handler) {
                 console.error('Invalid arguments for addEventListener', {element, event, handler});
                 return;
             }
             
-            element.addEventListener(event, handler);
-            this.eventListeners.push({ element, event, handler });
+            element.addEventListener(event, handler, options);
+            this.eventListeners.push({ element, event, handler, options });
         }
 
         getCSRFToken() {
@@ -113,6 +147,395 @@
             }
         }
 
+        escapeHtml(text) {
+            return String(text ?? '').replace(/[&<>"']/g, (char) => ({
+                '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+            })[char]);
+        }
+
+        // Server datetimes are UTC 'YYYY-MM-DD HH:MM:SS' strings, shown in local time
+        formatServerDate(value, withYear = true) {
+            if (!value) return '';
+            const date = new Date(value.replace(' ', 'T') + 'Z');
+            const pad = (number) => String(number).padStart(2, '0');
+            const day = `${pad(date.getMonth() + 1)}/${pad(date.getDate())}` + (withYear ? `/${date.getFullYear()}` : '');
+            return `${day} ${pad(date.getHours())}:${pad(date.getMinutes())}`;
+        }
+
+        // Same markup as whatsapp.chat._render_message_html, styled by chat_interface.css
+        renderMessageBubble(message) {
+            const state = message.state || '';
+            const stateLabel = state.charAt(0) + state.slice(1).toLowerCase();
+            const isSentByMe = OUTGOING_STATES.includes(state);
+
+            let content = 'Unsupported Message Type';
+            if (message.type === 'text') {
+                content = this.escapeHtml(message.text || 'Empty message').replace(/\n/g, '<br>');
+            } else if (message.type === 'media') {
+                const mediaType = message.media_type || '';
+                content = `📎 ${mediaType.charAt(0).toUpperCase()}${mediaType.slice(1).toLowerCase()} Media`;
+                if (message.text) {
+                    content += `: ${this.escapeHtml(message.text).replace(/\n/g, '<br>')}`;
+                }
+            } else if (message.type === 'template') {
+                content = `📋 Template: ${this.escapeHtml(message.text)}`;
+            }
+
+            const author = isSentByMe ? 'You' : this.escapeHtml(this.currentSelectedContactName);
+            const error = message.error
+                ? `<br><span class="message-error">Error: ${this.escapeHtml(message.error)}</span>`
+                : '';
+            return `<div class="message-bubble ${isSentByMe ? 'outgoing' : 'incoming'} message-state-${state.toLowerCase()}" data-message-id="${message.id}">`
+                + `<div><strong class="message-author">${author}</strong>`
+                + `<small class="message-date">${this.formatServerDate(message.date)}</small></div>`
+                + `<div class="message-content">${content}</div>`
+                + `<div class="message-status"><span title="${stateLabel}">${STATUS_ICONS[state] || '○'} ${stateLabel}</span>${error}</div>`
+                + `</div>`;
+        }
+
+        renderConversation(messages) {
+            if (!messages.length) {
+                return `<div class="empty-chat-state">
+                    <div class="empty-chat-icon">📭</div>
+                    <h4>No messages found</h4>
+                    <p>No conversation history with ${this.escapeHtml(this.currentSelectedContactName)}</p>
+                    <small>Start by sending a message below</small>
+                </div>`;
+            }
+            return messages.map((message) => this.renderMessageBubble(message)).join('');
+        }
+
+        renderContactItem(contact, index) {
+            const name = this.escapeHtml(contact.name);
+            const count = contact.message_count;
+            const unread = contact.unread_count
+                ? `<span class="contact-unread" title="Unread messages">${contact.unread_count}</span>`
+                : '';
+            const selected = contact.partner_id === this.currentSelectedPartnerId ? ' selected' : '';
+            return `<div class="contact-item${unread ? ' unread' : ''}${selected}" style="top: ${index * CONTACT_ROW_HEIGHT}px;" data-partner-id="${contact.partner_id}" data-contact-name="${name}">`
+                + `<div class="contact-row"><div>`
+                + `<strong class="contact-name">${name}</strong><br>`
+                + `<small class="contact-phone">${this.escapeHtml(contact.phone || 'No phone')}</small><br>`
+                + `<small class="contact-preview">${this.escapeHtml(contact.preview)}</small>`
+                + `</div><div class="contact-meta">`
+                + `<small class="contact-date">${this.formatServerDate(contact.date, false)}</small><br>`
+                + `<span class="contact-count">${count} msg${count !== 1 ? 's' : ''}</span>${unread}`
+                + `</div></div></div>`;
+        }
+
+        getContactsContainer() {
+            return document.querySelector('.chat-contacts .contacts-list') ||
+                   document.querySelector('.o_whatsapp_contacts_html');
+        }
+
+        hasContactFilters() {
+            const filters = this.contactFilters;
+            return Boolean(filters.search || filters.unread || filters.active_session);
+        }
+
+        // Virtualised sidebar: a list as tall as all loaded rows, holding only the rows in view
+        renderContactsWindow() {
+            const container = this.getContactsContainer();
+            const scroller = document.querySelector('.chat-contacts');
+            if (!container || !scroller) return;
+
+            if (!this.contacts.length) {
+                const message = this.hasContactFilters()
+                    ? 'No conversations match the filters.'
+                    : 'No conversations found. Send a message to start chatting or wait for incoming messages.';
+                container.innerHTML = `<p class="text-muted" style="padding: 10px;">${message}</p>`;
+                return;
+            }
+
+            let list = container.querySelector('.contacts-virtual-list');
+            if (!list) {
+                container.innerHTML = '<div class="contacts-virtual-list"></div>';
+                list = container.querySelector('.contacts-virtual-list');
+            }
+            list.style.height = `${this.contacts.length * CONTACT_ROW_HEIGHT}px`;
+
+            const listTop = list.getBoundingClientRect().top - scroller.getBoundingClientRect().top + scroller.scrollTop;
+            const viewTop = scroller.scrollTop - listTop;
+            const first = Math.max(0, Math.floor(viewTop / CONTACT_ROW_HEIGHT) - CONTACTS_OVERSCAN);
+            const last = Math.min(this.contacts.length,
+                                  Math.ceil((viewTop + scroller.clientHeight) / CONTACT_ROW_HEIGHT) + CONTACTS_OVERSCAN);
+            list.innerHTML = this.contacts.slice(first, last)
+                .map((contact, offset) => this.renderContactItem(contact, first + offset)).join('');
+
+            if (this.contactsHasMore && last >= this.contacts.length - CONTACTS_OVERSCAN) {
+                this.loadMoreContacts();
+            }
+        }
+
+        scheduleContactsRender() {
+            if (this.contactsRenderFrame) return;
+            this.contactsRenderFrame = requestAnimationFrame(() => {
+                this.contactsRenderFrame = null;
+                this.renderContactsWindow();
+            });
+        }
+
+        // Conversations loaded so far, refreshed as a whole when the list changes
+        contactsLimit() {
+            return Math.max(CONTACTS_PAGE_SIZE, this.contacts.length);
+        }
+
+        async loadMoreContacts() {
+            if (this.isLoadingContacts || !this.contactsHasMore) return;
+
+            this.isLoadingContacts = true;
+            const filters = this.contactFilters;
+            try {
+                const result = await this.makeRpcCall(
+                    'whatsapp.chat',
+                    'rpc_get_contacts',
+                    [],
+                    { limit: CONTACTS_PAGE_SIZE, offset: this.contacts.length, filters }
+                );
+                // The filters changed while the page was in flight
+                if (filters !== this.contactFilters) return;
+
+                const known = new Set(this.contacts.map((contact) => contact.partner_id));
+                this.contacts.push(...result.contacts.filter((contact) => !known.has(contact.partner_id)));
+                this.contactsHasMore = result.has_more;
+                this.renderContactsWindow();
+            } catch (error) {
+                console.error('Error loading more contacts:', error);
+            } finally {
+                this.isLoadingContacts = false;
+            }
+        }
+
+        applyContactFilters(changes) {
+            this.contactFilters = { ...this.contactFilters, ...changes };
+            this.contactsVersion = null;
+            this.contacts = [];
+            this.contactsHasMore = false;
+            const scroller = document.querySelector('.chat-contacts');
+            if (scroller) scroller.scrollTop = 0;
+            this.updateContactsList();
+        }
+
+
+        // One round trip per refresh: the open conversation's delta, its contact's
+        // session and the contacts list, each only when it changed
+        async poll({ withConversation = true } = {}) {
+            const partnerId = withConversation ? this.currentSelectedPartnerId : null;
+            const result = await this.makeRpcCall(
+                'whatsapp.chat',
+                'rpc_poll',
+                [],
+                {
+                    partner_id: partnerId,
+                    contacts_version: this.contactsVersion,
+                    last_message_id: this.lastMessageId,
+                    oldest_message_id: this.oldestMessageId,
+                    conversation_version: this.conversationVersion,
+                    contacts_limit: this.contactsLimit(),
+                    contacts_filters: this.contactFilters,
+                    // Messages shown in a visible tab are read
+                    mark_read: document.visibilityState === 'visible',
+                }
+            );
+
+            // The user may have switched contact while the call was in flight
+            if (partnerId && partnerId === this.currentSelectedPartnerId) {
+                this.applyPartnerResult(result.partner);
+                this.applyMessagesResult(result.messages);
+                this.applySessionResult(result.session);
+            }
+            await this.applyContactsResult(result.contacts);
+        }
+
+        // Fetch only what changed in the open conversation and append/patch it in place
+        async loadMessagesDelta(partnerId) {
+            if (partnerId !== this.currentSelectedPartnerId) return;
+            await this.poll();
+        }
+
+        applyMessagesResult(delta) {
+            if (delta.not_modified) return;
+
+            if (delta.reset) {
+                this.applyConversationReset(delta);
+                return;
+            }
+            if (delta.messages.length) {
+                this.applyMessagesDelta(delta.messages);
+            }
+            this.lastMessageId = delta.last_message_id;
+            this.conversationVersion = delta.version;
+        }
+
+        applyPartnerResult(partner) {
+            if (partner && partner.name && partner.name !== this.currentSelectedContactName) {
+                this.currentSelectedContactName = partner.name;
+                this.updateChatHeader(partner.name);
+            }
+        }
+
+        applySessionResult(sessionInfo) {
+            if (sessionInfo && this.hasSessionStateChanged(sessionInfo)) {
+                this.lastSessionState = sessionInfo;
+                this.updateInputFields(sessionInfo, this.currentSelectedPartnerId);
+                this.updateSessionUI(sessionInfo);
+                if (sessionInfo.session_active && sessionInfo.expires_at) {
+                    this.startSessionTimer(sessionInfo.expires_at);
+                } else {
+                    this.stopSessionTimer();
+                }
+            }
+        }
+
+        // Replace the displayed window of the conversation, and the cursors that go with it
+        applyConversationReset(conversation) {
+            this.renderMessages(this.renderConversation(conversation.messages));
+            this.oldestMessageId = conversation.oldest_message_id;
+            this.hasMoreHistory = conversation.has_more;
+            this.lastMessageId = conversation.last_message_id;
+            this.conversationVersion = conversation.version;
+        }
+
+        // Message search in the left panel; results replace the conversations while a query is typed
+        async runMessageSearch(query, append = false) {
+            const resultsContainer = document.querySelector('.o_lipachat_search_results');
+            const contactsContainer = document.querySelector('.o_whatsapp_contacts_html');
+            if (!resultsContainer) return;
+
+            this.searchQuery = query.trim();
+            if (!this.searchQuery) {
+                resultsContainer.style.display = 'none';
+                resultsContainer.innerHTML = '';
+                if (contactsContainer) contactsContainer.style.display = '';
+                return;
+            }
+
+            const offset = append ? this.searchOffset : 0;
+            try {
+                const searched = this.searchQuery;
+                const page = await this.makeRpcCall(
+                    'whatsapp.chat',
+                    'rpc_search_messages',
+                    [searched],
+                    { offset }
+                );
+                // A newer query was typed while this one was in flight
+                if (searched !== this.searchQuery) return;
+
+                const itemsHtml = page.results.map((result) => this.renderSearchResult(result)).join('');
+                resultsContainer.querySelector('.search-load-more')?.remove();
+                if (append) {
+                    resultsContainer.insertAdjacentHTML('beforeend', itemsHtml);
+                } else {
+                    resultsContainer.innerHTML = itemsHtml || '<p class="text-muted" style="padding: 10px;">No messages found.</p>';
+                }
+                if (page.has_more) {
+                    resultsContainer.insertAdjacentHTML('beforeend',
+                        '<button type="button" class="btn btn-link search-load-more">Load more results</button>');
+                }
+                this.searchOffset = offset + page.results.length;
+                resultsContainer.style.display = '';
+                if (contactsContainer) contactsContainer.style.display = 'none';
+            } catch (error) {
+                console.error('Error searching messages:', error);
+            }
+        }
+
+        renderSearchResult(result) {
+            const name = this.escapeHtml(result.name);
+            // Escape first, then mark the (escaped) occurrences of the query
+            const escapedQuery = this.escapeHtml(this.searchQuery).replace(/[.*+?^${}()|[\]\\]/g, '\\$&');
+            const snippet = this.escapeHtml(result.snippet).replace(new RegExp(escapedQuery, 'gi'), (match) => `<mark>${match}</mark>`);
+            return `<div class="search-result-item" data-message-id="${result.message_id}" data-partner-id="${result.partner_id}" data-contact-name="${name}">`
+                + `<strong class="search-result-name">${name}</strong>`
+                + `<small class="search-result-date">${this.formatServerDate(result.date, false)}</small>`
+                + `<small class="search-result-snippet">${snippet}</small>`
+                + `</div>`;
+        }
+
+        // Open a search result: select its contact and scroll to the message, loading the history up to it if needed
+        async jumpToMessage(partnerId, contactName, messageId) {
+            await this.selectContact(partnerId, contactName);
+            partnerId = parseInt(partnerId);
+            if (partnerId !== this.currentSelectedPartnerId) return;
+
+            const messagesContainer = document.getElementById('chat-messages-container');
+            if (!messagesContainer) return;
+
+            let bubble = messagesContainer.querySelector(`[data-message-id="${messageId}"]`);
+            if (!bubble) {
+                const around = await this.makeRpcCall(
+                    'whatsapp.chat',
+                    'rpc_get_messages_around',
+                    [partnerId, messageId]
+                );
+                if (partnerId !== this.currentSelectedPartnerId) return;
+                this.applyConversationReset(around);
+                bubble = messagesContainer.querySelector(`[data-message-id="${messageId}"]`);
+            }
+            if (bubble) {
+                bubble.scrollIntoView({ behavior: 'smooth', block: 'center' });
+                bubble.classList.add('message-highlight');
+                setTimeout(() => bubble.classList.remove('message-highlight'), 2000);
+            }
+        }
+
+        // Prepend the page of history preceding the oldest loaded message
+        async loadOlderMessages() {
+            const partnerId = this.currentSelectedPartnerId;
+            if (!partnerId || !this.hasMoreHistory || !this.oldestMessageId || this.isLoadingHistory) return;
+
+            this.isLoadingHistory = true;
+            try {
+                const page = await this.makeRpcCall(
+                    'whatsapp.chat',
+                    'rpc_get_messages_page',
+                    [partnerId, this.oldestMessageId]
+                );
+                if (partnerId !== this.currentSelectedPartnerId) return;
+
+                const messagesContainer = document.getElementById('chat-messages-container');
+                if (!messagesContainer) return;
+
+                // Keep the message under the user's eyes in place while the page grows above it
+                const previousHeight = messagesContainer.scrollHeight;
+                messagesContainer.insertAdjacentHTML('afterbegin', this.renderConversation(page.messages));
+                messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+
+                this.oldestMessageId = page.oldest_message_id || this.oldestMessageId;
+                this.hasMoreHistory = page.has_more;
+            } catch (error) {
+                console.error('Error loading older messages:', error);
+            } finally {
+                this.isLoadingHistory = false;
+            }
+        }
+
+        applyMessagesDelta(messages) {
+            const messagesContainer = document.getElementById('chat-messages-container');
+            if (!messagesContainer) return;
+
+            const wasAtBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop - messagesContainer.clientHeight < 50;
+            let appended = false;
+
+            for (const message of messages) {
+                const existing = messagesContainer.querySelector(`[data-message-id="${message.id}"]`);
+                if (existing) {
+                    // Status change (delivered, read...): patch the bubble only
+                    existing.outerHTML = this.renderMessageBubble(message);
+                } else {
+                    const emptyState = messagesContainer.querySelector('.empty-chat-state');
+                    if (emptyState) emptyState.remove();
+                    messagesContainer.insertAdjacentHTML('beforeend', this.renderMessageBubble(message));
+                    appended = true;
+                }
+            }
+
+            if (appended && wasAtBottom) {
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            }
+        }
+
         updateOdooFields(partnerId, contactName) {
             const contactField = this.findOdooField('contact');
             if (contactField) {
@@ -129,27 +552,6 @@
             }
         }
 
-        async getSessionInfo(partnerId) {
-            if (this.sessionCheckInProgress) {
-                return this.lastSessionState; // Return cached state if check in progress
-            }
-    
-            this.sessionCheckInProgress = true;
-            try {
-                const partner = await this.getPartnerDetails(partnerId);
-                const sessionInfo = await this.makeRpcCall(
-                    'whatsapp.chat',
-                    'check_contact_active_session',
-                    [partner.mobile || partner.phone, partner.mobile || partner.phone]
-                );
-                
-                this.lastSessionState = sessionInfo;
-                return sessionInfo;
-            } finally {
-                this.sessionCheckInProgress = false;
-            }
-        }
-
         async selectContact(partnerId, contactName) {
             try {
                 partnerId = parseInt(partnerId);
@@ -166,29 +568,18 @@
                 this.currentSelectedPartnerId = partnerId;
                 this.currentSelectedContactName = contactName || `Contact ${partnerId}`;
                 this.lastMessageId = 0;
+                    this.oldestMessageId = null;
+                this.hasMoreHistory = false;
+                this.conversationVersion = null;
+                // The previous contact's session state must not hide this one's
+                this.lastSessionState = null;
                 
                 this.updateContactSelectionUI(partnerId);
                 this.updateChatHeader(this.currentSelectedContactName);
                 this.updateOdooFields(partnerId, this.currentSelectedContactName);
     
-                // Get session info using unified method
-                const sessionInfo = await this.getSessionInfo(partnerId);
-                this.updateInputFields(sessionInfo, partnerId);
-    
-                // Start session timer if active
-                if (sessionInfo.session_active && sessionInfo.expires_at) {
-                    this.startSessionTimer(sessionInfo.expires_at);
-                } else {
-                    this.stopSessionTimer();
-                }
-                
-                // Load messages
-                const messagesHtml = await this.makeRpcCall(
-                    'whatsapp.chat',
-                    'rpc_get_messages_html',
-                    [partnerId]
-                );
-                this.renderMessages(messagesHtml);
+                // Messages, session state and contact details in one round trip
+                await this.loadMessagesDelta(partnerId);
                 
             } catch (error) {
                 console.error("Error in selectContact:", error);
@@ -202,16 +593,6 @@
 
 
 
-        async getPartnerDetails(partnerId) {
-            return await this.makeRpcCall(
-                'res.partner',
-                'read',
-                [partnerId, ['name', 'mobile', 'phone']]
-            ).then(results => results[0]);
-        }
-        
-        
-
         updateChatHeader(contactName) {
             const chatHeader = document.getElementById('chat-header-contact-name');
             if (chatHeader) {
@@ -270,7 +651,7 @@
                 messageInput.dispatchEvent(new Event('change', { bubbles: true }));
                 messageInput.dispatchEvent(new Event('input', { bubbles: true }));
 
-                await this.selectContact(this.currentSelectedPartnerId, this.currentSelectedContactName);
+                await this.loadMessagesDelta(this.currentSelectedPartnerId);
 
                 if (result && result.status === 'success') {
 
@@ -368,27 +749,39 @@
 
         async updateContactsList() {
             try {
-                const contactsHtml = await this.makeRpcCall(
+                const result = await this.makeRpcCall(
                     'whatsapp.chat',
-                    'rpc_get_contacts_html',
+                    'rpc_get_contacts',
                     [],
-                    {}
+                    { limit: this.contactsLimit(), version: this.contactsVersion, filters: this.contactFilters }
                 );
-                
-                const contactsContainer = document.querySelector('.chat-contacts .contacts-list') ||
-                                        document.querySelector('.o_whatsapp_contacts_html');
+                await this.applyContactsResult(result);
+            } catch (error) {
+                console.error("Error updating contacts list:", error);
+                this.updateInputFields({ session_active: false }, null, false);
+            }
+        }
+
+        async applyContactsResult(result) {
+            try {
+                const contactsContainer = this.getContactsContainer();
                 if (contactsContainer) {
-                    contactsContainer.innerHTML = contactsHtml;
+                    if (!result.not_modified) {
+                        this.contacts = result.contacts;
+                        this.contactsHasMore = result.has_more;
+                        this.contactsVersion = result.version;
+                        this.renderContactsWindow();
+                    }
                     
-                    // Check if we have contacts after update
-                    const hasContacts = contactsContainer.querySelector('.contact-item') !== null;
+                    // Check if we have contacts after update; an empty filtered list still has some
+                    const hasContacts = this.contacts.length > 0 || this.hasContactFilters();
                     
                     // Restore selection UI if a contact was selected
                     if (this.currentSelectedPartnerId) {
                         this.updateContactSelectionUI(this.currentSelectedPartnerId);
-                        // Update input fields for selected contact
-                        const sessionInfo = await this.getSessionInfo(this.currentSelectedPartnerId);
-                        this.updateInputFields(sessionInfo, this.currentSelectedPartnerId, hasContacts);
+                        // Update input fields for selected contact, with the session state just fetched
+                        this.updateInputFields(this.lastSessionState || { session_active: false },
+                                               this.currentSelectedPartnerId, hasContacts);
                     } else {
                         // No contact selected - show appropriate state
                         if (hasContacts) {
@@ -408,60 +801,51 @@
 
 
 
+    // Polling is only a fallback: while the bus is connected, changes are pushed
     startAutoRefresh() {
         if (this.autoRefreshInterval) {
             clearInterval(this.autoRefreshInterval);
         }
 
+        this.busConnected = Boolean(window.lipachatBusConnected);
         this.autoRefreshInterval = setInterval(async () => {
             if (document.visibilityState === 'visible') {
-                try {
-
-                    // Always update contacts list
-                    await this.updateContactsList();
-                    
-                    // Only refresh messages if a contact is selected
-                    if (this.currentSelectedPartnerId) {
-                        const messagesHtml = await this.makeRpcCall(
-                            'whatsapp.chat',
-                            'rpc_get_messages_html',
-                            [this.currentSelectedPartnerId]
-                        );
-                        this.renderMessages(messagesHtml);
-                        
-                        // Check session status
-                        const sessionInfo = await this.getSessionInfo(this.currentSelectedPartnerId);
-                        if (sessionInfo && this.hasSessionStateChanged(sessionInfo)) {
-                            this.updateInputFields(sessionInfo, this.currentSelectedPartnerId);
-                            this.updateSessionUI(sessionInfo);
-                        }
-                    }
-                } catch (error) {
-                    console.error("Error during auto-refresh:", error);
-                }
+                await this.refreshChat();
             }
-        }, 10000);
+        }, this.busConnected ? 60000 : 10000);
     }
 
+        // Refresh the contacts list, and the open conversation when it is among partnerIds (all by default)
+        async refreshChat(partnerIds = null) {
+            try {
+                const withConversation = !partnerIds || partnerIds.has(this.currentSelectedPartnerId);
+                await this.poll({ withConversation });
+            } catch (error) {
+                console.error("Error during auto-refresh:", error);
+            }
+        }
+
+        // Bus notification: coalesce bursts (sync, bulk sends) into one refresh
+        handleChatUpdate(payload) {
+            (payload.partner_ids || []).forEach((partnerId) => this.pendingChatUpdates.add(partnerId));
+            clearTimeout(this.chatUpdateTimeout);
+            this.chatUpdateTimeout = setTimeout(() => this.applyChatUpdates(), 300);
+        }
+
+        async applyChatUpdates() {
+            // Hidden tabs catch up when they become visible again
+            if (!this.isInitialized || document.visibilityState !== 'visible') return;
+
+            const partnerIds = this.pendingChatUpdates;
+            this.pendingChatUpdates = new Set();
+            await this.refreshChat(partnerIds);
+        }
+
 
         async refreshMessagesOnly(partnerId) {
             try {
-                // Get fresh messages
-                const messagesHtml = await this.makeRpcCall(
-                    'whatsapp.chat',
-                    'rpc_get_messages_html',
-                    [partnerId]
-                );
-                
-                // Only update messages, don't touch input fields
-                this.renderMessages(messagesHtml);
-                
-                // Check session status separately and only update if changed
-                const sessionInfo = await this.getSessionInfo(partnerId);
-                if (sessionInfo && this.hasSessionStateChanged(sessionInfo)) {
-                    this.updateInputFields(sessionInfo, partnerId);
-                    this.updateSessionUI(sessionInfo);
-                }
+                // New and changed messages and the session state, in one poll
+                await this.loadMessagesDelta(partnerId);
             } catch (error) {
                 console.error("Error refreshing messages:", error);
             }
@@ -513,16 +897,15 @@
         }
 
         updateContactSelectionUI(partnerId) {
+            // Selection styles live in chat_interface.css
             document.querySelectorAll('.contact-item').forEach(item => {
-                item.style.backgroundColor = 'white';
-                item.style.border = '1px solid #eee';
+                item.style.backgroundColor = '';
+                item.style.border = '';
                 item.classList.remove('selected');
             });
             
             const selectedItem = document.querySelector(`.contact-item[data-partner-id="${partnerId}"]`);
             if (selectedItem) {
-                selectedItem.style.backgroundColor = '#e8f5e8';
-                selectedItem.style.border = '2px solid #25D366';
                 selectedItem.classList.add('selected');
                 selectedItem.scrollIntoView({ behavior: 'smooth', block: 'nearest' });
             }
@@ -548,12 +931,13 @@
                     // Render pre-loaded content
                     const contactsContainer = document.querySelector('.chat-contacts .contacts-list') ||
                                             document.querySelector('.o_whatsapp_contacts_html');
-                    if (contactsContainer && initialData.contacts_html) {
-                        contactsContainer.innerHTML = initialData.contacts_html;
+                    if (contactsContainer && initialData.contacts) {
+                        this.contacts = initialData.contacts;
+                        this.renderContactsWindow();
                     }
                     
-                    if (initialData.messages_html) {
-                        this.renderMessages(initialData.messages_html);
+                    if (initialData.messages) {
+                        this.renderMessages(this.renderConversation(initialData.messages));
                     }
                     
                     return; // We're done
@@ -1042,6 +1426,9 @@
             this.currentSelectedPartnerId = null;
             this.currentSelectedContactName = null;
             this.lastMessageId = 0;
+            this.oldestMessageId = null;
+            this.hasMoreHistory = false;
+            this.conversationVersion = null;
             
             console.log('Cleaned up for non-WhatsApp interface');
         }
@@ -1098,6 +1485,66 @@
                 }
             });
         
+            // Contact filters
+            this.addEventListener(document, 'input', (event) => {
+                if (event.target.matches('.o_lipachat_contact_filter')) {
+                    clearTimeout(this.contactFilterTimeout);
+                    const search = event.target.value.trim();
+                    this.contactFilterTimeout = setTimeout(() => this.applyContactFilters({ search }), 300);
+                }
+            });
+            this.addEventListener(document, 'change', (event) => {
+                if (event.target.matches('.o_lipachat_filter_unread')) {
+                    this.applyContactFilters({ unread: event.target.checked });
+                } else if (event.target.matches('.o_lipachat_filter_session')) {
+                    this.applyContactFilters({ active_session: event.target.checked });
+                }
+            });
+
+            // Message search
+            this.addEventListener(document, 'input', (event) => {
+                if (event.target.matches('.o_lipachat_message_search')) {
+                    clearTimeout(this.searchTimeout);
+                    const query = event.target.value;
+                    this.searchTimeout = setTimeout(() => this.runMessageSearch(query), 300);
+                }
+            });
+            this.addEventListener(document, 'click', (event) => {
+                const result = event.target.closest('.search-result-item');
+                if (result) {
+                    event.preventDefault();
+                    this.jumpToMessage(result.dataset.partnerId, result.dataset.contactName, parseInt(result.dataset.messageId));
+                } else if (event.target.closest('.search-load-more')) {
+                    event.preventDefault();
+                    this.runMessageSearch(this.searchQuery, true);
+                }
+            });
+
+            // Chat changes pushed over the bus (see lipachat_bus_service.js)
+            this.addEventListener(window, 'lipachat:chat-updated', (event) => {
+                this.handleChatUpdate(event.detail || {});
+            });
+            this.addEventListener(window, 'lipachat:bus-status', (event) => {
+                if (this.isInitialized && event.detail.connected !== this.busConnected) {
+                    this.startAutoRefresh();
+                }
+            });
+            this.addEventListener(document, 'visibilitychange', () => {
+                if (document.visibilityState === 'visible' && this.pendingChatUpdates.size) {
+                    this.applyChatUpdates();
+                }
+            });
+
+            // Older history is loaded when scrolling near the top; scroll events
+            // do not bubble, hence the capture phase
+            this.addEventListener(document, 'scroll', (event) => {
+                if (event.target.id === 'chat-messages-container' && event.target.scrollTop < 80) {
+                    this.loadOlderMessages();
+                } else if (event.target.classList?.contains('chat-contacts')) {
+                    this.scheduleContactsRender();
+                }
+            }, true);
+        
             // Message input handling
             this.setupMessageInput();
             this.setupTemplateSelection();
@@ -1109,6 +1556,9 @@
             this.currentSelectedPartnerId = null;
             this.currentSelectedContactName = null;
             this.lastMessageId = 0;
+            this.oldestMessageId = null;
+            this.hasMoreHistory = false;
+            this.conversationVersion = null;
     
             // Clear chat header
             this.updateChatHeader('Select a contact to start chatting');
@@ -1230,12 +1680,13 @@
                         // Render pre-loaded content
                         const contactsContainer = document.querySelector('.chat-contacts .contacts-list') ||
                                                 document.querySelector('.o_whatsapp_contacts_html');
-                        if (contactsContainer && initialData.contacts_html) {
-                            contactsContainer.innerHTML = initialData.contacts_html;
+                        if (contactsContainer && initialData.contacts) {
+                            this.contacts = initialData.contacts;
+                            this.renderContactsWindow();
                         }
                         
-                        if (initialData.messages_html) {
-                            this.renderMessages(initialData.messages_html);
+                        if (initialData.messages) {
+                            this.renderMessages(this.renderConversation(initialData.messages));
                         }
                         
                         return; // We're done
@@ -1257,6 +1708,18 @@
 
             this.stopSessionTimer();
 
+            clearTimeout(this.chatUpdateTimeout);
+            this.chatUpdateTimeout = null;
+            clearTimeout(this.searchTimeout);
+            this.searchTimeout = null;
+            clearTimeout(this.contactFilterTimeout);
+            this.contactFilterTimeout = null;
+            if (this.contactsRenderFrame) {
+                cancelAnimationFrame(this.contactsRenderFrame);
+                this.contactsRenderFrame = null;
+            }
+            this.pendingChatUpdates.clear();
+
             if (this.autoRefreshInterval) {
                 clearInterval(this.autoRefreshInterval);
                 this.autoRefreshInterval = null;
@@ -1275,8 +1738,8 @@
             }
 
             
-            this.eventListeners.forEach(({ element, event, handler }) => {
-                element.removeEventListener(event, handler);
+            this.eventListeners.forEach(({ element, event, handler, options }) => {
+                element.removeEventListener(event, handler, options);
             });
             this.eventListeners = [];
             
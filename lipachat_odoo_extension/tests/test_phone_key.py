@@ -0,0 +1,44 @@
+from odoo.tests.common import TransactionCase, tagged
+
+from ..models.lipachat_contact_session import _phone_key_sql
+from ..models.lipachat_message import _normalize_phone
+
+
+@tagged('post_install', '-at_install')
+class TestPhoneKeySql(TransactionCase):
+
+    PHONES = [
+        '+254 712 345 678',
+        '+254-712-345-678',
+        '  +254712345678',
+        '0712 345 678',
+        '00254712345678',
+        '712345678',
+        '254712345678',
+        '12025550123',
+        '+1 (202) 555-0123',
+        '07123',
+        '0',
+        '',
+        '+0712345678',
+        '+1234567',
+        '+1234567890123456',
+        'not a number',
+    ]
+
+    def _sql_key(self, phone, country_code):
+        self.env.cr.execute(f"SELECT {_phone_key_sql('%(phone)s::varchar')}", {
+            'phone': phone,
+            'country_code': country_code or None,
+        })
+        return self.env.cr.fetchone()[0]
+
+    def test_sql_key_matches_normalize_phone(self):
+        for country_code in ('254', '1', False):
+            for phone in self.PHONES:
+                with self.subTest(phone=phone, country_code=country_code):
+                    self.assertEqual(self._sql_key(phone, country_code),
+                                     _normalize_phone(phone, country_code) or None)
+
+    def test_sql_key_of_missing_phone(self):
+        self.assertIsNone(self._sql_key(None, '254'))